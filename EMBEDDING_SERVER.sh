@@ -0,0 +1 @@
+uvicorn embedding_server:app --host 0.0.0.0 --port 8001
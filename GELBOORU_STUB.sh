@@ -0,0 +1 @@
+uvicorn gelbooru_stub:app --host 127.0.0.1 --port 8002
@@ -1 +1,13 @@
-celery -A model_worker worker --loglevel=INFO -E -P solo
+# MODEL_WORKER_MODE=threads (default): one process, one loaded model, inference batches and queries share a thread pool
+# (forward passes take turns on the full intra-op pool, the other threads download, decode and query Qdrant)
+# MODEL_WORKER_MODE=split: a solo worker for inference batches and a threaded worker for queries, each loads the model
+MODEL_WORKER_MODE=${MODEL_WORKER_MODE:-threads}
+MODEL_WORKER_THREADS=${MODEL_WORKER_THREADS:-8}
+
+if [ "$MODEL_WORKER_MODE" = "split" ]; then
+  celery -A model_worker worker --loglevel=INFO -E -P solo -Q model_worker -n inference@%h &
+  celery -A model_worker worker --loglevel=INFO -E -P threads -c "$MODEL_WORKER_THREADS" -Q model_queries -n queries@%h &
+  wait
+else
+  celery -A model_worker worker --loglevel=INFO -E -P threads -c "$MODEL_WORKER_THREADS" -Q model_worker,model_queries
+fi
@@ -1 +1 @@
-celery -A tasks worker --loglevel=INFO -E
+celery -A tasks worker --loglevel=INFO -E -B
@@ -0,0 +1,34 @@
+import asyncio
+import time
+from typing import Any, Optional
+
+from celery.result import AsyncResult
+from fastapi import HTTPException
+from starlette.requests import Request
+
+
+async def wait_for_result(result: AsyncResult, timeout: float, request: Optional[Request] = None,
+                          poll_interval: float = 0.02, max_poll_interval: float = 0.25) -> Any:
+    """
+    Waits for a Celery result without blocking the event loop.
+
+    The result backend is polled from a worker thread with a growing interval. If the timeout passes or the
+    client goes away, the task is revoked so the worker doesn't waste time on an answer nobody will read.
+    """
+    deadline = time.monotonic() + timeout
+
+    while not await asyncio.to_thread(result.ready):
+        if request is not None and await request.is_disconnected():
+            result.revoke()
+            # 499 = client closed request, nobody is there to receive this anyway
+            raise HTTPException(status_code=499, detail="Client disconnected")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            result.revoke()
+            raise HTTPException(status_code=504, detail="Timed out waiting for task")
+
+        await asyncio.sleep(min(poll_interval, remaining))
+        poll_interval = min(poll_interval * 2, max_poll_interval)
+
+    return await asyncio.to_thread(result.get, timeout=max(deadline - time.monotonic(), 1))
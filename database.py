@@ -2,6 +2,7 @@ import time
 from typing import Annotated, Optional
 
 import motor.motor_asyncio
+from pymongo import MongoClient, IndexModel, ASCENDING, DESCENDING, ReturnDocument
 from pydantic import BeforeValidator
 from pydantic import ConfigDict, BaseModel, Field, EmailStr
 
@@ -14,12 +15,49 @@ db = client.get_database("supaarchive")
 
 artwork_collection = db.get_collection("artwork")
 translation_collection = db.get_collection("translations")
+stats_collection = db.get_collection("stats")
+tag_stats_collection = db.get_collection("tag_stats")
+similar_collection = db.get_collection("similar_artworks")
+
+# Synchronous client for code that runs in worker processes or threads, created lazily so that it is never
+# shared across a fork.
+sync_client = None
+
+
+def get_sync_database():
+    global sync_client
+    if sync_client is None:
+        sync_client = MongoClient(CONNECTION_STRING)
+    return sync_client.get_database("supaarchive")
 
 # Represents an ObjectId field in the database.
 # It will be represented as a `str` on the model so that it can be serialized to JSON.
 PyObjectId = Annotated[str, BeforeValidator(str)]
 
 
+ARTWORK_INDEXES = [
+    IndexModel([("added_at", DESCENDING), ("_id", DESCENDING)], name="added_at_id"),
+    # Gallery listing: first pages of sets, newest first
+    IndexModel([("page_no", ASCENDING), ("added_at", DESCENDING), ("_id", DESCENDING)], name="page_no_added_at_id"),
+    IndexModel([("pixiv_source_id", ASCENDING), ("page_no", ASCENDING)], name="pixiv_source_id_page_no"),
+    IndexModel([("gelbooru_id", ASCENDING)], name="gelbooru_id", sparse=True),
+    IndexModel([("tags", ASCENDING)], name="tags"),
+    # Integrity scan walks the archive in bucket key order
+    IndexModel([("s3_object_name", ASCENDING)], name="s3_object_name"),
+    # Only covers artworks that still need an embedding, so it stays tiny. Queries have to use the same
+    # {"$type": "null"} filter (not None, which also matches a missing field) for the planner to pick it.
+    IndexModel([("embedding_version", ASCENDING), ("_id", ASCENDING)], name="embedding_version_missing",
+               partialFilterExpression={"embedding_version": {"$type": "null"}}),
+]
+
+
+async def ensure_indexes():
+    await artwork_collection.create_indexes(ARTWORK_INDEXES)
+    await tag_stats_collection.create_index([("count", DESCENDING)], name="count")
+    # Finds the lists that mention a removed artwork
+    await similar_collection.create_index([("neighbours._id", ASCENDING)], name="neighbours_id")
+
+
 def get_unix_timestamp():
     return int(time.time())
 
@@ -40,4 +78,34 @@ class Artwork(BaseModel):
     pixiv_author_id: Optional[int] = None
     gelbooru_id: Optional[int] = None
 
-    vitEmbedding: Optional[str] = None
+    # Version of the embedding stored in Qdrant, None until the artwork has been embedded
+    embedding_version: Optional[int] = None
+    # Set on near-duplicates of another artwork, which are kept out of the vector index
+    duplicate_of: Optional[str] = None
+
+
+def build_artwork_upsert(artwork: Artwork, source_fields: dict):
+    """
+    Builds the filter and update that insert an artwork, or merge it into the existing document with the same hash.
+
+    Tags are merged with $addToSet, source_fields (e.g. pixiv_source_id) overwrite the stored values and
+    everything else is only written on insert.
+    """
+    document = artwork.model_dump(by_alias=True)
+    image_id = document.pop("_id")
+    tags = document.pop("tags")
+    for field in source_fields:
+        document.pop(field, None)
+
+    update = {"$addToSet": {"tags": {"$each": tags}}, "$setOnInsert": document}
+    if source_fields:
+        update["$set"] = source_fields
+    return {"_id": image_id}, update
+
+
+def upsert_artwork(collection, artwork: Artwork, source_fields: dict):
+    """Atomic single round trip insert-or-merge, returns the previous document's tags or None if it was inserted."""
+    query, update = build_artwork_upsert(artwork, source_fields)
+    previous = collection.find_one_and_update(query, update, upsert=True, projection={"tags": 1},
+                                              return_document=ReturnDocument.BEFORE)
+    return previous["tags"] if previous is not None else None
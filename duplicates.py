@@ -0,0 +1,80 @@
+from pymongo import UpdateOne, UpdateMany
+from qdrant_client.models import SearchRequest, PointIdsList, SetPayload, SetPayloadOperation
+
+import config
+from neighbours import forget_neighbours
+from search import similar_filter
+from vector_store import point_id, search_params, record_changes, COLLECTION_NAME
+
+# Cosine similarity above which two images count as the same picture (re-encodes, resizes, small crops).
+# Pages of one pixiv set are never compared, they routinely score above 0.95 against each other. None disables.
+DUPLICATE_THRESHOLD = getattr(config, "DUPLICATE_THRESHOLD", 0.97)
+
+
+def find_duplicates(qdrant_client, entries, limit=1):
+    """
+    Looks up the closest indexed image above DUPLICATE_THRESHOLD for every (artwork, vector) pair in one batch call.
+
+    Returns a list with, per entry, the image IDs of the matches ordered by similarity (empty if it is unique).
+    """
+    if DUPLICATE_THRESHOLD is None or not entries:
+        return [[] for _ in entries]
+
+    results = qdrant_client.search_batch(COLLECTION_NAME, requests=[
+        SearchRequest(vector=vector, filter=similar_filter(artwork["_id"], artwork.get("pixiv_source_id")), limit=limit,
+                      score_threshold=DUPLICATE_THRESHOLD, with_payload=["image_id"], params=search_params())
+        for artwork, vector in entries
+    ])
+    return [[point.payload["image_id"] for point in points] for points in results]
+
+
+def link_duplicates(db, qdrant_client, duplicates):
+    """
+    Folds duplicates into their canonical artwork, duplicates maps duplicate image ID -> canonical image ID.
+
+    The canonical artwork gets the tags and source IDs of the duplicate, the duplicate keeps its document with a
+    duplicate_of link but loses its point, so it no longer shows up in searches or the similar artworks.
+    """
+    if not duplicates:
+        return 0
+
+    # Resolve chains (a copy of a copy), so every link goes straight to the artwork that stays indexed
+    for image_id, canonical_id in duplicates.items():
+        while canonical_id in duplicates:
+            canonical_id = duplicates[canonical_id]
+        duplicates[image_id] = canonical_id
+
+    record_changes(list(duplicates) + list(set(duplicates.values())))
+
+    artwork_collection = db.get_collection("artwork")
+    copies = artwork_collection.find({"_id": {"$in": list(duplicates)}},
+                                     {"tags": 1, "pixiv_source_id": 1, "gelbooru_id": 1})
+
+    operations = []
+    for copy in copies:
+        canonical_id = duplicates[copy["_id"]]
+        update = {"$addToSet": {"tags": {"$each": copy["tags"]}}}
+        # Keep every source link, without overwriting the canonical artwork's own
+        for field in ("pixiv_source_id", "gelbooru_id"):
+            if copy.get(field) is not None:
+                operations.append(UpdateOne({"_id": canonical_id, field: None}, {"$set": {field: copy[field]}}))
+        operations.append(UpdateOne({"_id": canonical_id}, update))
+        operations.append(UpdateOne({"_id": copy["_id"]}, {"$set": {"duplicate_of": canonical_id}}))
+        # Anything that pointed at the duplicate now points at the canonical artwork
+        operations.append(UpdateMany({"duplicate_of": copy["_id"]}, {"$set": {"duplicate_of": canonical_id}}))
+    artwork_collection.bulk_write(operations, ordered=True)
+
+    qdrant_client.delete(COLLECTION_NAME, points_selector=PointIdsList(points=[point_id(image_id) for image_id in duplicates]))
+    forget_neighbours(db, list(duplicates))
+
+    canonicals = artwork_collection.find({"_id": {"$in": list(set(duplicates.values()))}},
+                                         {"tags": 1, "pixiv_source_id": 1})
+    qdrant_client.batch_update_points(COLLECTION_NAME, update_operations=[
+        SetPayloadOperation(set_payload=SetPayload(
+            payload={"tags": canonical["tags"], "pixiv_source_id": canonical.get("pixiv_source_id")},
+            points=[point_id(canonical["_id"])]))
+        for canonical in canonicals
+    ])
+
+    print("Linked {0} duplicates".format(len(duplicates)))
+    return len(duplicates)
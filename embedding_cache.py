@@ -0,0 +1,70 @@
+import re
+from array import array
+from collections import OrderedDict
+from threading import Lock
+
+import config
+import redis_conn
+
+TEXT_EMBEDDING_CACHE_SIZE = getattr(config, "TEXT_EMBEDDING_CACHE_SIZE", 4096)
+TEXT_EMBEDDING_CACHE_TTL = getattr(config, "TEXT_EMBEDDING_CACHE_TTL", 60 * 60 * 24 * 7)
+
+
+def normalize_query(query):
+    """Queries that only differ in case or whitespace produce the same cache entry."""
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+class TextEmbeddingCache:
+    """
+    Two-level cache for text embeddings: an in-process LRU in front of Redis.
+
+    Entries are keyed by model name and normalized query, so switching models never serves stale vectors.
+    Vectors are stored in Redis as packed float32 to keep them small.
+    """
+
+    def __init__(self, max_entries=TEXT_EMBEDDING_CACHE_SIZE, ttl=TEXT_EMBEDDING_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.model_name = f"{config.VIT_MODEL_NAME}/{config.VIT_MODEL_PRETRAINED}"
+
+    def key(self, query):
+        return f"textembedding:{self.model_name}:{normalize_query(query)}"
+
+    def get_local(self, query):
+        key = self.key(query)
+        with self.lock:
+            vector = self.entries.get(key)
+            if vector is not None:
+                self.entries.move_to_end(key)
+            return vector
+
+    def set_local(self, query, vector):
+        key = self.key(query)
+        with self.lock:
+            self.entries[key] = vector
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get(self, query):
+        vector = self.get_local(query)
+        if vector is not None:
+            return vector
+
+        packed = redis_conn.redis_client.get(self.key(query))
+        if packed is None:
+            return None
+
+        vector = array("f", packed).tolist()
+        self.set_local(query, vector)
+        return vector
+
+    def set(self, query, vector):
+        self.set_local(query, vector)
+        redis_conn.redis_client.setex(self.key(query), self.ttl, array("f", vector).tobytes())
+
+
+text_embedding_cache = TextEmbeddingCache()
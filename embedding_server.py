@@ -0,0 +1,24 @@
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+import inference
+import model_worker
+
+# Low-latency path for text-only encodes that skips the Celery broker.
+# Run next to the model worker with EMBEDDING_SERVER.sh and point config.EMBEDDING_RPC_URL at it.
+app = FastAPI()
+
+
+class TextEncodeRequest(BaseModel):
+    query: str
+
+
+@app.on_event("startup")
+def load_model():
+    inference.get_model_instances()
+
+
+@app.post("/encode/text")
+def encode_text(payload: TextEncodeRequest):
+    # Plain def so FastAPI runs inference in its threadpool, get_model_instances guards the shared model
+    return {"vector": model_worker.encode_text(payload.query)}
@@ -0,0 +1,89 @@
+import io
+import os
+import random
+from xml.sax.saxutils import escape
+
+from fastapi import FastAPI, HTTPException, Request, Response
+from PIL import Image
+
+# Local stand-in for the Gelbooru API, to exercise import_gelbooru without hitting the real site.
+# Run it with GELBOORU_STUB.sh and set config.GELBOORU_API_URL = "http://localhost:8002/".
+#
+# Posts have IDs 1 to GELBOORU_STUB_POSTS, all tagged "stub" plus one of "stub_0", "stub_1" or "stub_2". Images of
+# the IDs in GELBOORU_STUB_FAILING (comma separated) answer 500 until POST /stub/heal.
+#
+# Checking an import (with config.GELBOORU_PAGE_SIZE = 100):
+# - Paging: import "stub" with the default 250 posts, GET /stub/queries shows the pages "stub", "stub id:<151",
+#   "stub id:<51" and an empty "stub id:<1", and GET /api/importgelbooru?tag=stub reports 250 imported.
+# - Resume: import with max_posts=100, the checkpoint stops at before_id 151, a second run starts at id:<151.
+# - Known IDs: import "stub_0" after "stub", every post is counted as skipped and no image is fetched again
+#   (GET /stub/queries lists the image requests too).
+# - Failures: with GELBOORU_STUB_FAILING=200,120 the walk still finishes and reports both IDs as failed. After
+#   POST /stub/heal the next run retries exactly these two before fetching anything newer.
+app = FastAPI()
+
+POST_COUNT = int(os.environ.get("GELBOORU_STUB_POSTS", 250))
+failing_ids = {int(post_id) for post_id in os.environ.get("GELBOORU_STUB_FAILING", "").split(",") if post_id}
+queries = []
+
+
+def post_tags(post_id):
+    return ["stub", f"stub_{post_id % 3}"]
+
+
+def matches(post_id, tags):
+    for tag in tags:
+        if tag.startswith("id:<"):
+            if post_id >= int(tag[len("id:<"):]):
+                return False
+        elif tag not in post_tags(post_id):
+            return False
+    return True
+
+
+def post_xml(request, post_id):
+    return (f"<post><id>{post_id}</id><file_url>{escape(str(request.base_url))}images/{post_id}.png</file_url>"
+            f"<tags>{' '.join(post_tags(post_id))}</tags><width>64</width><height>64</height><rating>general</rating>"
+            f"<change>0</change></post>")
+
+
+@app.get("/")
+@app.get("/index.php")
+def index(request: Request, s: str = "post", tags: str = "", limit: int = 100, pid: int = 0):
+    if s != "post":
+        raise HTTPException(status_code=404)
+    queries.append({"tags": tags, "limit": limit, "pid": pid})
+
+    # Newest first like Gelbooru
+    post_ids = [post_id for post_id in range(POST_COUNT, 0, -1) if matches(post_id, tags.split())]
+    page = post_ids[pid * limit:(pid + 1) * limit]
+    body = f'<?xml version="1.0" encoding="UTF-8"?><posts count="{len(post_ids)}" offset="{pid * limit}">' + \
+           "".join(post_xml(request, post_id) for post_id in page) + "</posts>"
+    return Response(content=body, media_type="application/xml")
+
+
+@app.get("/images/{post_id}.png")
+def image(post_id: int):
+    queries.append({"image": post_id})
+    if post_id in failing_ids:
+        raise HTTPException(status_code=500)
+    if not 1 <= post_id <= POST_COUNT:
+        raise HTTPException(status_code=404)
+
+    # Noise seeded by the ID, so every post has its own hash and isn't mistaken for a broken object
+    rng = random.Random(post_id)
+    image = Image.frombytes("RGB", (64, 64), bytes(rng.getrandbits(8) for _ in range(64 * 64 * 3)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return Response(content=buffer.getvalue(), media_type="image/png")
+
+
+@app.get("/stub/queries")
+def list_queries():
+    return queries
+
+
+@app.post("/stub/heal")
+def heal():
+    failing_ids.clear()
+    return {"failing": []}
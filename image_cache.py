@@ -0,0 +1,344 @@
+import asyncio
+import os
+import re
+import shutil
+import tempfile
+import time
+from collections import OrderedDict, defaultdict
+from threading import Lock
+
+import config
+import redis_conn
+
+IMAGE_CACHE_DIR = getattr(config, "IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "supaarchive-images"))
+IMAGE_CACHE_MEMORY_BYTES = getattr(config, "IMAGE_CACHE_MEMORY_BYTES", 64 * 1024 * 1024)
+IMAGE_CACHE_DISK_BYTES = getattr(config, "IMAGE_CACHE_DISK_BYTES", 5 * 1024 * 1024 * 1024)
+IMAGE_CACHE_REDIS_BYTES = getattr(config, "IMAGE_CACHE_REDIS_BYTES", 1024 * 1024 * 1024)
+
+# Redis keys live in their own namespace, so clearing the image cache never touches Celery results
+REDIS_PREFIX = "imagecache"
+REDIS_INDEX_KEY = f"{REDIS_PREFIX}:index"
+REDIS_BYTES_KEY = f"{REDIS_PREFIX}:bytes"
+# Entries put there by the warming tasks that haven't been requested yet, and how that worked out
+REDIS_WARMED_KEY = f"{REDIS_PREFIX}:warmed"
+REDIS_WARM_STATS_KEY = f"{REDIS_PREFIX}:warmstats"
+
+# Image IDs are SHA-256 hex digests. They end up in file paths and Redis glob patterns, so nothing else gets through.
+IMAGE_ID_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+def is_image_id(value):
+    return IMAGE_ID_PATTERN.fullmatch(value) is not None
+
+
+class CacheCounters:
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.lock = Lock()
+
+    def increment(self, tier, variant, event, amount=1):
+        with self.lock:
+            self.counts[(tier, variant, event)] += amount
+
+    def snapshot(self):
+        with self.lock:
+            report = defaultdict(lambda: defaultdict(dict))
+            for (tier, variant, event), count in self.counts.items():
+                report[tier][variant][event] = count
+            return {tier: dict(variants) for tier, variants in report.items()}
+
+
+counters = CacheCounters()
+
+
+class MemoryTier:
+    """Byte-bounded in-process LRU for the hottest images."""
+
+    def __init__(self, max_bytes=IMAGE_CACHE_MEMORY_BYTES):
+        self.max_bytes = max_bytes
+        # A single image may use at most 1/16th of the tier, so one huge original can't flush everything
+        self.max_item_bytes = max_bytes // 16
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, variant, image_id):
+        with self.lock:
+            content = self.entries.get((variant, image_id))
+            if content is not None:
+                self.entries.move_to_end((variant, image_id))
+        counters.increment("memory", variant, "hits" if content is not None else "misses")
+        return content
+
+    def set(self, variant, image_id, content):
+        if len(content) > self.max_item_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop((variant, image_id), None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[(variant, image_id)] = content
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                (evicted_variant, _), evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                counters.increment("memory", evicted_variant, "evictions")
+
+    def clear(self, variant=None, image_id=None):
+        with self.lock:
+            for key in [key for key in self.entries if (variant is None or key[0] == variant)
+                                                      and (image_id is None or key[1] == image_id)]:
+                self.size -= len(self.entries.pop(key))
+
+
+class DiskTier:
+    """
+    Size-bounded on-disk cache.
+
+    Access times are tracked through the file mtime, eviction removes the least recently used files. Entries are
+    read into memory rather than served by path, a file can be evicted between the lookup and the response.
+    """
+
+    def __init__(self, directory=IMAGE_CACHE_DIR, max_bytes=IMAGE_CACHE_DISK_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.size = sum(entry.stat().st_size for _, entry in self.scan())
+
+    def scan(self):
+        if not os.path.isdir(self.directory):
+            return
+        for variant in os.scandir(self.directory):
+            if not variant.is_dir():
+                continue
+            for shard in os.scandir(variant.path):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.is_file() and not entry.name.endswith(".tmp"):
+                        yield variant.name, entry
+
+    def path(self, variant, image_id):
+        if not is_image_id(image_id):
+            raise ValueError(f"Invalid image ID: {image_id}")
+        return os.path.join(self.directory, variant, image_id[:2], f"{image_id}.webp")
+
+    def get(self, variant, image_id):
+        """Returns the cached content, or None."""
+        path = self.path(variant, image_id)
+        try:
+            os.utime(path)
+            with open(path, "rb") as file:
+                content = file.read()
+        except FileNotFoundError:
+            counters.increment("disk", variant, "misses")
+            return None
+        counters.increment("disk", variant, "hits")
+        return content
+
+    def set(self, variant, image_id, content):
+        path = self.path(variant, image_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write and rename, so a concurrent reader never sees a partial file. mkstemp gives every writer its own
+        # temporary file, two threads may store the same image at once.
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(content)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+        with self.lock:
+            self.size += len(content)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Evict down to 90% so we don't rescan the directory on every write
+        entries = sorted(self.scan(), key=lambda item: item[1].stat().st_mtime)
+        self.size = sum(entry.stat().st_size for _, entry in entries)
+        for variant, entry in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self.size -= size
+            counters.increment("disk", variant, "evictions")
+
+    def clear(self, variant=None, image_id=None):
+        with self.lock:
+            if image_id is not None:
+                if variant is not None:
+                    variants = [variant]
+                else:
+                    variants = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+                for name in variants:
+                    try:
+                        path = self.path(name, image_id)
+                        size = os.stat(path).st_size
+                        os.remove(path)
+                        self.size -= size
+                    except FileNotFoundError:
+                        pass
+            else:
+                shutil.rmtree(os.path.join(self.directory, variant) if variant else self.directory, ignore_errors=True)
+                self.size = sum(entry.stat().st_size for _, entry in self.scan())
+
+
+class RedisTier:
+    """
+    Shared cache between web processes.
+
+    Byte usage is tracked in a counter next to a sorted set of entries by insertion time, the oldest entries are
+    evicted once the budget is exceeded. Entries have no TTL since image IDs are content hashes.
+
+    Pass a client when running outside the web app's event loop (e.g. in a Celery task).
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_REDIS_BYTES, client=None):
+        self.max_bytes = max_bytes
+        self.client = client
+
+    def connection(self):
+        return self.client or redis_conn.async_redis_client
+
+    def key(self, variant, image_id):
+        if image_id != "*" and not is_image_id(image_id):
+            raise ValueError(f"Invalid image ID: {image_id}")
+        return f"{REDIS_PREFIX}:{variant}:{image_id}"
+
+    async def get(self, variant, image_id):
+        redis = self.connection()
+        key = self.key(variant, image_id)
+        # One round trip, the SREM is a no-op on a miss. Only the first read of a warmed entry pays for a second one.
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.srem(REDIS_WARMED_KEY, key)
+            content, first_use = await pipe.execute()
+        counters.increment("redis", variant, "hits" if content is not None else "misses")
+        if content is not None and first_use:
+            await redis.hincrby(REDIS_WARM_STATS_KEY, "used", 1)
+        return content
+
+    async def exists(self, variant, image_id):
+        return await self.connection().exists(self.key(variant, image_id)) > 0
+
+    async def set(self, variant, image_id, content, warmed=False):
+        redis = self.connection()
+        key = self.key(variant, image_id)
+
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.strlen(key)
+            pipe.set(key, content)
+            pipe.zadd(REDIS_INDEX_KEY, {key: time.time()})
+            if warmed:
+                pipe.sadd(REDIS_WARMED_KEY, key)
+                pipe.hincrby(REDIS_WARM_STATS_KEY, "warmed", 1)
+            previous_size = (await pipe.execute())[0]
+
+        size = await redis.incrby(REDIS_BYTES_KEY, len(content) - previous_size)
+        while size > self.max_bytes:
+            oldest = await redis.zpopmin(REDIS_INDEX_KEY, 16)
+            if not oldest:
+                break
+            members = [member for member, _ in oldest]
+            evicted_unused = await redis.srem(REDIS_WARMED_KEY, *members)
+            if evicted_unused:
+                await redis.hincrby(REDIS_WARM_STATS_KEY, "evicted_unused", evicted_unused)
+            size = await self.remove(members)
+            for member in members:
+                counters.increment("redis", member.decode("utf-8").split(":")[1], "evictions")
+
+    async def remove(self, keys):
+        redis = self.connection()
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.strlen(key)
+            sizes = await pipe.execute()
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.delete(*keys)
+            pipe.zrem(REDIS_INDEX_KEY, *keys)
+            pipe.srem(REDIS_WARMED_KEY, *keys)
+            pipe.decrby(REDIS_BYTES_KEY, sum(sizes))
+            size = (await pipe.execute())[-1]
+        return size
+
+    async def warm_stats(self):
+        stats = await self.connection().hgetall(REDIS_WARM_STATS_KEY)
+        return {field.decode("utf-8"): int(value) for field, value in stats.items()}
+
+    async def clear(self, variant=None, image_id=None):
+        redis = self.connection()
+        if variant is not None and image_id is not None:
+            await self.remove([self.key(variant, image_id)])
+            return
+
+        pattern = self.key(variant or "*", image_id or "*")
+        keys = []
+        async for key in redis.scan_iter(match=pattern, count=1000):
+            keys.append(key)
+            if len(keys) >= 1000:
+                await self.remove(keys)
+                keys = []
+        if keys:
+            await self.remove(keys)
+
+
+class TieredImageCache:
+    def __init__(self):
+        self.memory = MemoryTier()
+        self.disk = DiskTier()
+        self.redis = RedisTier()
+
+    async def get(self, variant, image_id):
+        """Returns the content or None, checking the fastest tier first."""
+        content = self.memory.get(variant, image_id)
+        if content is not None:
+            return content
+
+        content = await asyncio.to_thread(self.disk.get, variant, image_id)
+        if content is not None:
+            self.memory.set(variant, image_id, content)
+            return content
+
+        content = await self.redis.get(variant, image_id)
+        if content is not None:
+            # Promote, so the next request doesn't need the network round trip
+            self.memory.set(variant, image_id, content)
+            await asyncio.to_thread(self.disk.set, variant, image_id, content)
+            return content
+
+        return None
+
+    async def set(self, variant, image_id, content):
+        self.memory.set(variant, image_id, content)
+        await asyncio.to_thread(self.disk.set, variant, image_id, content)
+        await self.redis.set(variant, image_id, content)
+
+    async def clear(self, variant=None, image_id=None):
+        """Clears matching entries from every tier, the memory tier only for this process."""
+        self.memory.clear(variant, image_id)
+        await asyncio.to_thread(self.disk.clear, variant, image_id)
+        await self.redis.clear(variant, image_id)
+
+    async def warm_stats(self):
+        return await self.redis.warm_stats()
+
+    def stats(self):
+        return {
+            "counters": counters.snapshot(),
+            "memory_bytes": self.memory.size,
+            "disk_bytes": self.disk.size,
+        }
+
+
+image_cache = TieredImageCache()
@@ -0,0 +1,168 @@
+import asyncio
+
+import httpx
+from fastapi import HTTPException
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+
+import s3
+from database import artwork_collection
+from image_cache import image_cache, is_image_id
+from imgproxy import VARIANTS, imgproxy_url
+
+http_client = None
+in_flight = {}
+
+
+def get_http_client():
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(timeout=httpx.Timeout(30, connect=5),
+                                        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32))
+    return http_client
+
+
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+
+class InFlightFetch:
+    """
+    A single imgproxy request that any number of clients can stream from while it is still downloading.
+
+    The fetch runs as its own task, so a client going away doesn't abort the cache fill for everyone else.
+    """
+
+    def __init__(self):
+        self.status_code = None
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.condition = asyncio.Condition()
+        # The event loop only keeps weak references to tasks, the flight holds on to its fetch
+        self.task = None
+
+    async def update(self, **changes):
+        async with self.condition:
+            for name, value in changes.items():
+                setattr(self, name, value)
+            self.condition.notify_all()
+
+    async def add_chunk(self, chunk):
+        async with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    async def wait_for_status(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.status_code is not None or self.done)
+        return self.status_code
+
+    async def stream(self):
+        position = 0
+        while True:
+            async with self.condition:
+                await self.condition.wait_for(lambda: position < len(self.chunks) or self.done)
+                chunks = self.chunks[position:]
+                done, error = self.done, self.error
+            position += len(chunks)
+
+            for chunk in chunks:
+                yield chunk
+
+            if done and position >= len(self.chunks):
+                if error is not None:
+                    raise error
+                return
+
+
+def flight_key(image_id, variant):
+    return f"{image_id}:{variant}"
+
+
+def etag(image_id, variant):
+    # Image IDs are content hashes and variants are deterministic, so the tag is known without fetching anything
+    return f'"{image_id}-{variant}"'
+
+
+def etag_matches(if_none_match, tag):
+    """If-None-Match may be "*" or a comma-separated list of tags, weak (W/) tags match too."""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == tag:
+            return True
+    return False
+
+
+async def fetch(flight, image_id, variant, source_url):
+    try:
+        try:
+            async with get_http_client().stream("GET", imgproxy_url(variant, source_url)) as response:
+                await flight.update(status_code=response.status_code)
+                if response.status_code != 200:
+                    return
+
+                async for chunk in response.aiter_bytes():
+                    await flight.add_chunk(chunk)
+        except Exception as e:
+            print(f"imgproxy fetch for {image_id} ({variant}) failed: {e}")
+            await flight.update(error=e)
+            return
+        finally:
+            await flight.update(done=True)
+
+        # Every client already has the complete image, a failed write only means the next request fetches again.
+        # The flight stays registered until then, so requests in between are served from its chunks.
+        try:
+            await image_cache.set(variant, image_id, b"".join(flight.chunks))
+        except Exception as e:
+            print(f"Caching {image_id} ({variant}) failed: {e}")
+    finally:
+        in_flight.pop(flight_key(image_id, variant), None)
+
+
+async def serve(request: Request, image_id: str, variant: str):
+    _, ttl = VARIANTS[variant]
+    headers = {"ETag": etag(image_id, variant), "Cache-Control": f"public, max-age={ttl}, immutable"}
+
+    if not is_image_id(image_id):
+        raise HTTPException(status_code=404, detail="Artwork not found")
+
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        # "*" matches any tag, only answer 304 for artworks that exist
+        if not await artwork_collection.find_one({"_id": image_id}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Artwork not found")
+        return Response(status_code=304, headers=headers)
+
+    cached = await image_cache.get(variant, image_id)
+    if cached is not None:
+        return Response(content=cached, media_type="image/webp", headers=headers)
+
+    flight = in_flight.get(flight_key(image_id, variant))
+    if flight is None:
+        artwork = await artwork_collection.find_one({"_id": image_id}, {"s3_object_name": 1})
+        if not artwork:
+            raise HTTPException(status_code=404, detail="Artwork not found")
+
+        # Another request may have started the fetch while we were looking up the artwork
+        flight = in_flight.get(flight_key(image_id, variant))
+        if flight is None:
+            flight = InFlightFetch()
+            in_flight[flight_key(image_id, variant)] = flight
+            flight.task = asyncio.create_task(fetch(flight, image_id, variant,
+                                                    f"{s3.base_url}{artwork['s3_object_name']}"))
+
+    status_code = await flight.wait_for_status()
+    if status_code != 200:
+        raise HTTPException(status_code=502, detail="imgproxy request failed")
+
+    return StreamingResponse(flight.stream(), media_type="image/webp", headers=headers)
@@ -0,0 +1,20 @@
+import base64
+
+import httpx
+
+import config
+
+# imgproxy URL building, shared by the web app's proxy (image_proxy.py) and the warming tasks without pulling the
+# web stack into the Celery workers.
+
+# Variant name -> (imgproxy base URL, browser cache max-age in seconds)
+VARIANTS = {
+    "thumbnail": (config.IMGPROXY_THUMBNAIL_BASE_URL, 60 * 60 * 24 * 7),
+    "optimized": (config.IMGPROXY_OPTIMIZED_BASE_URL, 60 * 60 * 24),
+}
+
+
+def imgproxy_url(variant, source_url):
+    base_url, _ = VARIANTS[variant]
+    encoded_url = base64.b64encode(source_url.encode("utf-8")).decode("utf-8")
+    return httpx.URL(f"{base_url}{encoded_url}.webp")
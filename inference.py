@@ -0,0 +1,293 @@
+import contextlib
+import multiprocessing
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from threading import Lock, RLock
+
+import open_clip
+import torch
+from PIL import Image
+
+import config
+
+# Downloaded weights and exported encoders are kept here, so a restart never hits the network
+VIT_CACHE_DIR = getattr(config, "VIT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "supaarchive"))
+# "torchscript" replaces the encoders with an int8 dynamically quantized TorchScript export on CPU nodes.
+# The export is written to VIT_CACHE_DIR on first load and reused afterwards.
+VIT_EXPORT = getattr(config, "VIT_EXPORT", None)
+
+# Intra-op threads for CPU inference, None keeps torch's default (all cores)
+VIT_CPU_THREADS = getattr(config, "VIT_CPU_THREADS", None)
+# "auto" is fp16 autocast on CUDA and bf16 autocast on CPUs with native bf16 (AVX512-BF16/AMX), fp32 otherwise.
+# Can be forced to "fp32", "fp16" (CUDA only) or "bf16".
+VIT_PRECISION = getattr(config, "VIT_PRECISION", "auto")
+VIT_CHANNELS_LAST = getattr(config, "VIT_CHANNELS_LAST", True)
+# Images per forward pass, the next chunk is decoded while the current one runs. None = the whole batch at once
+VIT_INFERENCE_BATCH = getattr(config, "VIT_INFERENCE_BATCH", None)
+# Decode and resize in this many processes instead of the download threads, PIL holds the GIL for part of the work
+VIT_PREPROCESS_PROCESSES = getattr(config, "VIT_PREPROCESS_PROCESSES", 0)
+
+model, preprocess, tokenizer = None, None, None
+image_encoder, text_encoder = None, None
+# Filled in by load_model, reported with the worker's readiness
+load_report = None
+loadingMutex = Lock()
+# Forward passes run one at a time. Each already uses the whole intra-op pool, so concurrent passes from the worker's
+# threads would only oversubscribe the cores. Reentrant so a benchmark can hold it across its encode calls.
+inferenceMutex = RLock()
+preprocess_pool = None
+
+
+class ImageEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, images):
+        return self.model.encode_image(images)
+
+
+class TextEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, text):
+        return self.model.encode_text(text)
+
+
+def export_path(kind):
+    name = f"{config.VIT_MODEL_NAME}-{config.VIT_MODEL_PRETRAINED}-{kind}-int8.pt".replace("/", "_")
+    return os.path.join(VIT_CACHE_DIR, "exports", name)
+
+
+def export_encoders(model, tokenizer):
+    """Quantizes the linear layers to int8 and traces both encoders, returns the paths of the saved graphs."""
+    quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    image_size = model.visual.image_size
+    if isinstance(image_size, int):
+        image_size = (image_size, image_size)
+
+    os.makedirs(os.path.dirname(export_path("image")), exist_ok=True)
+    with torch.no_grad():
+        torch.jit.trace(ImageEncoder(quantized), torch.randn(1, 3, *image_size)).save(export_path("image"))
+        torch.jit.trace(TextEncoder(quantized), tokenizer(["export"])).save(export_path("text"))
+    return export_path("image"), export_path("text")
+
+
+def device_type():
+    return "cuda" if str(config.VIT_DEVICE).startswith("cuda") else "cpu"
+
+
+def cpu_supports_bf16():
+    try:
+        with open("/proc/cpuinfo") as cpuinfo:
+            flags = cpuinfo.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def resolve_precision():
+    if VIT_PRECISION != "auto":
+        return VIT_PRECISION
+    if device_type() == "cuda":
+        return "fp16"
+    # The int8 export has its own kernels, autocast would only add casts around them
+    if VIT_EXPORT == "torchscript" or not cpu_supports_bf16():
+        return "fp32"
+    return "bf16"
+
+
+def autocast(precision):
+    if precision == "fp16":
+        return torch.autocast("cuda", dtype=torch.float16)
+    if precision == "bf16":
+        return torch.autocast(device_type(), dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def set_channels_last(enabled):
+    # Only the eager model has weights to convert, traced graphs keep the layout they were exported with
+    if image_encoder is not None and not isinstance(image_encoder, torch.jit.ScriptModule):
+        model.to(memory_format=torch.channels_last if enabled else torch.contiguous_format)
+
+
+def load_model():
+    global model, preprocess, tokenizer, image_encoder, text_encoder, load_report
+    start_time = time.time()
+    if VIT_CPU_THREADS:
+        torch.set_num_threads(VIT_CPU_THREADS)
+
+    model, _, preprocess = open_clip.create_model_and_transforms(config.VIT_MODEL_NAME, pretrained=config.VIT_MODEL_PRETRAINED,
+                                                                 cache_dir=VIT_CACHE_DIR)
+    tokenizer = open_clip.get_tokenizer(config.VIT_MODEL_NAME)
+    model.eval()
+    model.to(config.VIT_DEVICE)
+
+    backend = "torch"
+    if VIT_EXPORT == "torchscript" and config.VIT_DEVICE == "cpu":
+        if not (os.path.exists(export_path("image")) and os.path.exists(export_path("text"))):
+            export_encoders(model, tokenizer)
+        image_encoder = torch.jit.load(export_path("image"))
+        text_encoder = torch.jit.load(export_path("text"))
+        backend = "torchscript-int8"
+    else:
+        image_encoder, text_encoder = model.encode_image, model.encode_text
+        set_channels_last(VIT_CHANNELS_LAST)
+
+    load_report = {"backend": backend, "device": config.VIT_DEVICE, "precision": resolve_precision(),
+                   "threads": torch.get_num_threads(), "channels_last": VIT_CHANNELS_LAST,
+                   "load_seconds": time.time() - start_time}
+    print("Model loaded ({backend} on {device}, {precision}, {threads} threads) in {load_seconds:.2f}s".format(**load_report))
+
+
+def get_model_instances():
+    with loadingMutex:
+        if model is None:
+            load_model()
+        return model, preprocess, tokenizer
+
+
+def decode_image(content, preprocess):
+    return preprocess(Image.open(BytesIO(content)).convert("RGB"))
+
+
+def limit_preprocess_threads():
+    # One process per core already, more threads each would only fight over them
+    torch.set_num_threads(1)
+
+
+def get_preprocess_pool(processes=VIT_PREPROCESS_PROCESSES):
+    global preprocess_pool
+    if preprocess_pool is None and processes:
+        # Spawn, forking a process that holds a loaded model and worker threads isn't safe
+        preprocess_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"),
+                                              initializer=limit_preprocess_threads)
+    return preprocess_pool
+
+
+def preprocess_image(content, preprocess):
+    """Decodes and resizes one downloaded image, in the preprocessing processes if configured."""
+    pool = get_preprocess_pool()
+    if pool is None:
+        return decode_image(content, preprocess)
+    return pool.submit(decode_image, content, preprocess).result()
+
+
+def encode_images(images, precision=None, channels_last=VIT_CHANNELS_LAST):
+    """Normalized embeddings for a list of preprocessed image tensors, as lists of floats."""
+    get_model_instances()
+    batch = torch.stack(images).to(config.VIT_DEVICE)
+    if channels_last:
+        batch = batch.contiguous(memory_format=torch.channels_last)
+
+    with inferenceMutex, torch.no_grad(), autocast(precision or resolve_precision()):
+        print("Running inference on batch of {0}".format(len(images)))
+        image_features = image_encoder(batch)
+        image_features /= image_features.norm(dim=-1, keepdim=True)
+
+    return image_features.float().cpu().numpy().tolist()
+
+
+def encode_texts(texts):
+    """Normalized embeddings for a list of (already normalized) query strings, as lists of floats."""
+    get_model_instances()
+    text = tokenizer(texts).to(config.VIT_DEVICE)
+
+    with inferenceMutex, torch.no_grad(), autocast(resolve_precision()):
+        print("Running inference")
+        text_features = text_encoder(text)
+        text_features /= text_features.norm(dim=-1, keepdim=True)
+
+    return text_features.float().cpu().numpy().tolist()
+
+
+def embedding_dimension():
+    return len(encode_texts(["dimension probe"])[0])
+
+
+def benchmark_text_latency(queries=("a cat", "blue hair girl with a sword", "sunset over the sea"), runs=20):
+    """Per-query text encode latency in milliseconds, measured without the embedding cache."""
+    encode_texts([queries[0]])  # warm-up, the first call pays for lazy initialisation
+    timings = []
+    for index in range(runs):
+        start_time = time.perf_counter()
+        encode_texts([queries[index % len(queries)]])
+        timings.append((time.perf_counter() - start_time) * 1000)
+    timings.sort()
+    return {"runs": runs, "p50_ms": statistics.median(timings), "p95_ms": timings[int(len(timings) * 0.95) - 1],
+            "max_ms": timings[-1]}
+
+
+def benchmark_image_throughput(batch_size=32, runs=3):
+    """
+    Images/sec of the image encoder for every combination of thread count, precision and memory layout that applies
+    to this node, on random input so downloads don't skew the numbers.
+    """
+    get_model_instances()
+    image_size = model.visual.image_size
+    if isinstance(image_size, int):
+        image_size = (image_size, image_size)
+    images = [torch.randn(3, *image_size) for _ in range(batch_size)]
+
+    if device_type() == "cuda":
+        thread_options = [torch.get_num_threads()]
+        precisions = ["fp32", "fp16"]
+    else:
+        cores = os.cpu_count() or 1
+        thread_options = sorted({1, max(1, cores // 2), cores})
+        precisions = ["fp32", "bf16"] if cpu_supports_bf16() and VIT_EXPORT != "torchscript" else ["fp32"]
+
+    # The thread count and memory layout are process-wide, queries must not run while they are changed
+    inferenceMutex.acquire()
+    default_threads = torch.get_num_threads()
+    results = []
+    try:
+        for threads in thread_options:
+            torch.set_num_threads(threads)
+            for precision in precisions:
+                for channels_last in (False, True):
+                    set_channels_last(channels_last)
+                    encode_images(images, precision=precision, channels_last=channels_last)  # warm-up
+                    start_time = time.perf_counter()
+                    for _ in range(runs):
+                        encode_images(images, precision=precision, channels_last=channels_last)
+                    elapsed = time.perf_counter() - start_time
+                    results.append({"threads": threads, "precision": precision, "channels_last": channels_last,
+                                    "images_per_second": batch_size * runs / elapsed})
+    finally:
+        torch.set_num_threads(default_threads)
+        set_channels_last(VIT_CHANNELS_LAST)
+        inferenceMutex.release()
+
+    for result in results:
+        print("{threads} threads, {precision}, channels_last={channels_last}: {images_per_second:.2f} images/sec".format(**result))
+    return results
+
+
+def benchmark_preprocessing(count=64, threads=8, processes=None):
+    """Images/sec of decode + resize for a 2048px JPEG, with the download thread pool alone and with processes."""
+    get_model_instances()
+    buffer = BytesIO()
+    Image.effect_noise((2048, 2048), 64).convert("RGB").save(buffer, format="JPEG", quality=90)
+    content = buffer.getvalue()
+
+    def measure(work):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(work, range(threads)))  # warm-up, spawning the processes isn't part of the rate
+            start_time = time.perf_counter()
+            list(executor.map(work, range(count)))
+            return count / (time.perf_counter() - start_time)
+
+    results = [{"mode": "threads", "images_per_second": measure(lambda _: decode_image(content, preprocess))}]
+    # A pool of its own, the configured preprocessing pool (or its absence) must survive the benchmark
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count() or 1,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=limit_preprocess_threads) as pool:
+        results.append({"mode": "processes", "images_per_second":
+                        measure(lambda _: pool.submit(decode_image, content, preprocess).result())})
+    return results
@@ -0,0 +1,45 @@
+import hashlib
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import config
+
+DOWNLOAD_CHUNK_SIZE = getattr(config, "DOWNLOAD_CHUNK_SIZE", 1024 * 1024)
+DOWNLOAD_TIMEOUT = getattr(config, "DOWNLOAD_TIMEOUT", (10, 120))
+
+# One pooled session per worker process, created lazily so it is never shared across a fork
+session = None
+
+
+def get_http_session():
+    global session
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16,
+                              max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    return session
+
+
+def download_to_file(url, file, headers=None):
+    """
+    Streams url into file in chunks, hashing while writing.
+
+    Memory use stays at one chunk regardless of the image size. Returns the SHA-256 hex digest and the number
+    of bytes written, the file is rewound to the start.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+
+    with get_http_session().get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as res:
+        res.raise_for_status()
+        for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            sha256.update(chunk)
+            file.write(chunk)
+            size += len(chunk)
+
+    file.seek(0)
+    return sha256.hexdigest(), size
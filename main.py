@@ -1,4 +1,6 @@
-import base64
+import asyncio
+import hashlib
+import json
 import os.path
 import time
 from io import BytesIO
@@ -6,17 +8,24 @@ from typing import Any
 
 import httpx
 import requests
-from fastapi import FastAPI, Body
+from fastapi import FastAPI, Body, HTTPException
 from starlette.requests import Request
-from starlette.responses import StreamingResponse, Response
 
 import config
+import image_proxy
+import maintenance
 import model_worker
 import redis_conn
 import s3
+import search as search_backend
 import tasks
-from database import artwork_collection, translation_collection
-from schema import PixivIndexPayload, PixivDownloadBatch
+from async_result import wait_for_result
+from database import db, artwork_collection, translation_collection, stats_collection, tag_stats_collection, \
+    similar_collection, ensure_indexes
+from embedding_cache import text_embedding_cache
+from image_cache import image_cache, is_image_id
+from schema import PixivIndexPayload
+from vector_store import EMBEDDING_VERSION
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
@@ -26,6 +35,21 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 templates = Jinja2Templates(directory="templates")
 
+# Seconds to wait on worker results before giving up, per endpoint
+SEARCH_TIMEOUT = getattr(config, "SEARCH_TIMEOUT", 30)
+SIMILAR_TIMEOUT = getattr(config, "SIMILAR_TIMEOUT", 10)
+TRANSLATE_TIMEOUT = getattr(config, "TRANSLATE_TIMEOUT", 60)
+
+# Seconds a next page stays marked as warmed, so reloads don't queue the same warming task again
+WARM_DEDUPE_SECONDS = getattr(config, "WARM_DEDUPE_SECONDS", 60)
+# How long a queued stats rebuild holds off further ones, should outlast a full reconcile_stats run
+STATS_RECONCILE_LOCK_SECONDS = getattr(config, "STATS_RECONCILE_LOCK_SECONDS", 60 * 10)
+
+# Optional embedding_server.py instance, text encodes go through Celery when unset
+EMBEDDING_RPC_URL = getattr(config, "EMBEDDING_RPC_URL", None)
+# Pooled, so cache misses reuse a kept-alive connection to the embedding server
+embedding_rpc_client = None
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["https://www.pixiv.net"],
@@ -35,6 +59,34 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def startup():
+    await ensure_indexes()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await image_proxy.close_http_client()
+    if embedding_rpc_client is not None:
+        await embedding_rpc_client.aclose()
+
+
+def get_embedding_rpc_client():
+    global embedding_rpc_client
+    if embedding_rpc_client is None:
+        embedding_rpc_client = httpx.AsyncClient(base_url=EMBEDDING_RPC_URL, timeout=SEARCH_TIMEOUT)
+    return embedding_rpc_client
+
+
+async def warm_next_page(kind, cursor, **kwargs):
+    """Queues warming of the page behind a cursor once per WARM_DEDUPE_SECONDS, without blocking the event loop."""
+    page = json.dumps([kind, cursor, kwargs], sort_keys=True).encode("utf-8")
+    key = f"warmpage:{hashlib.sha1(page).hexdigest()}"
+    if await redis_conn.async_redis_client.set(key, 1, nx=True, ex=WARM_DEDUPE_SECONDS):
+        # Publishing to the broker is a blocking socket write
+        await asyncio.to_thread(tasks.warm_next_page.apply_async, args=[kind, cursor], kwargs=kwargs, priority=0)
+
+
 @app.get("/")
 async def root(request: Request):
     return templates.TemplateResponse("home.html", {"request": request})
@@ -47,38 +99,63 @@ async def say_hello(name: str):
 
 @app.post("/userscript/pixiv")
 async def index_pixiv_artwork(pixiv_data: PixivIndexPayload):
-    # Check for existence of pixiv ID
-    if await artwork_collection.find_one({"pixiv_source_id": pixiv_data.illustration_id}):
+    # Check for existence of pixiv ID, sets missing some pages are resubmitted and only fetch those
+    if await artwork_collection.count_documents({"pixiv_source_id": pixiv_data.illustration_id}) >= len(pixiv_data.pages):
         print("Already exists")
         return {"message": "This artwork already exists."}
 
-    for idx, url in enumerate(pixiv_data.pages):
-        downloadImageBatch = PixivDownloadBatch(url=url, tags=pixiv_data.tags, title=pixiv_data.title,
-                                                description=pixiv_data.description,
-                                                illust_id=pixiv_data.illustration_id,
-                                                page_no=idx, author_id=pixiv_data.author_id,
-                                                author_name=pixiv_data.author_name)
-        print(downloadImageBatch.json().encode("utf-8"))
-        tasks.downloadPixivImage.delay(downloadImageBatch.model_dump())
+    # One task for the whole set instead of one per page
+    tasks.downloadPixivSet.delay(pixiv_data.model_dump())
+
+    return {"message": "The artwork has been submitted to SupaArchive.",
+            "progress_url": f"/userscript/pixiv/{pixiv_data.illustration_id}/progress"}
 
-    return {"message": "The artwork has been submitted to SupaArchive."}
+
+@app.get("/userscript/pixiv/{illustration_id}/progress")
+async def pixiv_set_progress(illustration_id: int):
+    progress = await redis_conn.async_redis_client.hgetall(tasks.pixiv_set_progress_key(illustration_id))
+    if not progress:
+        raise HTTPException(status_code=404, detail="No archiving job for this set")
+    progress = {field.decode("utf-8"): value.decode("utf-8") for field, value in progress.items()}
+    return {"status": progress["status"], "total": int(progress["total"]), "done": int(progress["done"]),
+            "failed": int(progress["failed"])}
+
+
+GALLERY_PROJECTION = {"s3_object_name": 1, "title": 1, "tags": 1, "added_at": 1, "embedding_version": 1}
 
 
 @app.get("/gallery")
-async def gallery(request: Request, page: int = 1):
-    latest_artworks = await artwork_collection.find({
-        "$or": [
-            {"page_no": {"$exists": False}},
-            {"page_no": 0}
-        ]
-    }).skip((page - 1) * 25).sort("added_at", -1).limit(25).to_list(25)
+async def gallery(request: Request, page: int = 1, after: str = None, before: str = None):
+    if page < 1:
+        raise HTTPException(status_code=400, detail="Invalid page")
+    try:
+        query, sort = search_backend.gallery_query(after=after, before=before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if after or before:
+        latest_artworks = await artwork_collection.find(query, GALLERY_PROJECTION).sort(sort).limit(25).to_list(25)
+        if before:
+            latest_artworks.reverse()
+    else:
+        latest_artworks = await artwork_collection.find(query, GALLERY_PROJECTION).sort(sort).skip((page - 1) * 25).limit(25).to_list(25)
+
     images = []
     for artwork in latest_artworks:
         images.append(
             {"url": f"{s3.base_url}{artwork['s3_object_name']}", "title": artwork["title"], "tags": artwork["tags"],
              "id": artwork["_id"],
-             "vitEmbedding": artwork["vitEmbedding"] is not None and len(artwork["vitEmbedding"]) > 0})
-    return templates.TemplateResponse("gallery.html", {"request": request, "images": images, "page": page})
+             "embedded": artwork.get("embedding_version") is not None})
+
+    next_cursor, previous_cursor = None, None
+    if len(latest_artworks) == 25:
+        next_cursor = search_backend.gallery_cursor(latest_artworks[-1])
+        await warm_next_page("gallery", next_cursor)
+    if page > 1 and latest_artworks:
+        previous_cursor = search_backend.gallery_cursor(latest_artworks[0])
+
+    return templates.TemplateResponse("gallery.html", {"request": request, "images": images, "page": page,
+                                                       "next_cursor": next_cursor, "previous_cursor": previous_cursor})
 
 
 @app.get("/administration")
@@ -91,9 +168,24 @@ async def image(request: Request, image_id: str):
     artwork = await artwork_collection.find_one({"_id": image_id})
     artwork["url"] = f"{s3.base_url}{artwork['s3_object_name']}"
 
-    similar_artwork_task = model_worker.get_similar.delay(image_id, limit=10)
-    similar_artwork_task.wait()
-    similar_artworks = similar_artwork_task.get()
+    # Near-duplicates have no vector of their own, show what is similar to the artwork they were merged into
+    similar_id = artwork.get("duplicate_of") or image_id
+    precomputed = await similar_collection.find_one({"_id": similar_id, "version": EMBEDDING_VERSION})
+    if precomputed is not None:
+        similar_artworks = precomputed["neighbours"]
+    elif artwork.get("embedding_version") is None:
+        similar_artworks = []
+    else:
+        # Not precomputed yet (or outdated), search now and have the list stored for the next view
+        model_worker.compute_similar.delay([similar_id])
+        similar_artwork_task = model_worker.get_similar.delay(similar_id, limit=10)
+        try:
+            similar_artworks = await wait_for_result(similar_artwork_task, SIMILAR_TIMEOUT, request) or []
+        except HTTPException as e:
+            if e.status_code != 504:
+                raise
+            # Render the page without similar artworks rather than failing it
+            similar_artworks = []
     for similar in similar_artworks:
         similar["url"] = f"{s3.base_url}{similar['s3_object_name']}"
 
@@ -101,7 +193,8 @@ async def image(request: Request, image_id: str):
     pixiv_other_pages = []
     # If image has a pixiv_source_id, check if there are others in the set
     if artwork["pixiv_source_id"]:
-        pixiv_other_pages = await artwork_collection.find({"pixiv_source_id": artwork["pixiv_source_id"]}).sort(
+        pixiv_other_pages = await artwork_collection.find({"pixiv_source_id": artwork["pixiv_source_id"]},
+                                                          {"title": 1, "page_no": 1}).sort(
             {"page_no": 1}).to_list(10)
         if len(pixiv_other_pages) > 1:
             pixiv_pages_flag = True
@@ -120,137 +213,117 @@ async def image(request: Request, image_id: str):
 
 
 @app.get("/imgproxy/thumbnail/{image_id}")
-async def imgproxy(image_id: str):
-    artwork = await artwork_collection.find_one({"_id": image_id})
-    encoded_url = base64.b64encode(f"{s3.base_url}{artwork['s3_object_name']}".encode("utf-8")).decode("utf-8")
-
-    redis = redis_conn.redis_client
-
-    # Check if file is cached in redis
-    if redis.exists(f"{artwork['_id']}:thumbnail"):
-        return Response(content=bytes(redis.get(f"{artwork['_id']}:thumbnail")), media_type="image/webp")
-
-    # return a streaming response
-    url = httpx.URL(f"{config.IMGPROXY_THUMBNAIL_BASE_URL}{encoded_url}.webp")
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        # save to redis
-        redis.setex(f"{artwork['_id']}:thumbnail", 60 * 60 * 24 * 7, response.content)
-
-        return Response(content=response.content, media_type="image/webp")
+async def imgproxy(request: Request, image_id: str):
+    return await image_proxy.serve(request, image_id, "thumbnail")
 
 
 @app.get("/imgproxy/optimized/{image_id}")
-async def optimized_artwork(image_id: str):
-    artwork = await artwork_collection.find_one({"_id": image_id})
-    encoded_url = base64.b64encode(f"{s3.base_url}{artwork['s3_object_name']}".encode("utf-8")).decode("utf-8")
-
-    redis = redis_conn.redis_client
-
-    # Check if file is cached in redis
-    if redis.exists(f"{artwork['_id']}:optimized"):
-        return Response(content=redis.get(f"{artwork['_id']}:optimized"), media_type="image/webp")
-
-    # return a streaming response
-    url = httpx.URL(f"{config.IMGPROXY_OPTIMIZED_BASE_URL}{encoded_url}.webp")
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        # save to redis
-        redis.setex(f"{artwork['_id']}:optimized", 60 * 60 * 24, response.content)
+async def optimized_artwork(request: Request, image_id: str):
+    return await image_proxy.serve(request, image_id, "optimized")
+
+
+async def get_query_embedding(request: Request, query: str):
+    # In-process LRU first, Redis second, only then ask the model
+    vector = text_embedding_cache.get_local(query)
+    if vector is None:
+        vector = await asyncio.to_thread(text_embedding_cache.get, query)
+    if vector is not None:
+        return vector
+
+    if EMBEDDING_RPC_URL:
+        response = await get_embedding_rpc_client().post("/encode/text", json={"query": query})
+        response.raise_for_status()
+        vector = response.json()["vector"]
+    else:
+        encode_task = model_worker.encode_query.apply_async(args=[query], priority=10)
+        vector = await wait_for_result(encode_task, SEARCH_TIMEOUT, request)
 
-        return Response(content=response.content, media_type="image/webp")
+    # The model side already stored it in Redis
+    text_embedding_cache.set_local(query, vector)
+    return vector
 
 
 @app.get("/search")
-async def search(request: Request, query: str = None, page: int = 1, neural: bool = False, group_sets: bool = False):
+async def search(request: Request, query: str = None, page: int = 1, neural: bool = False, group_sets: bool = False,
+                 cursor: str = None, hybrid: bool = False):
     start_time = time.time()
+    try:
+        # With a cursor, page is only the label of the page, tag search scrolls deeper than any offset bound
+        if cursor:
+            search_backend.decode_cursor(cursor, search_backend.HYBRID_CURSOR if hybrid else
+                                         search_backend.VECTOR_CURSOR if neural else search_backend.TAG_CURSOR)
+        else:
+            search_backend.page_offset(page, 25)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if query:
         if query.startswith("pixiv_id:"):
-            results = await artwork_collection.find({"pixiv_source_id": int(query.split(":")[1])}).sort(
+            results = await artwork_collection.find({"pixiv_source_id": int(query.split(":")[1])},
+                                                    search_backend.HYDRATION_PROJECTION).sort(
                 {"page_no": 1}).to_list(100)
             return templates.TemplateResponse("search.html",
                                               {"request": request, "results": results, "page": page, "query": query,
                                                "time": time.time() - start_time, "group_sets": group_sets})
         else:
             split_tags = query.split(" ")
-            results = []
-            if neural:
-                search_task = model_worker.neural_search.apply_async(args=[query], kwargs={"page": page, "limit": 25},
-                                                                     priority=10)
-                search_task.wait()
-                results = search_task.get()
+            if hybrid:
+                # One filtered vector query: free text ranks, tag:/-tag/artist: filter inside Qdrant
+                parsed = search_backend.parse_query(query)
+                text = search_backend.hybrid_text(parsed)
+                if not text:
+                    raise HTTPException(status_code=400,
+                                        detail="Hybrid search needs free text or a tag: to rank by")
+                vector = await get_query_embedding(request, text)
+                response = await asyncio.to_thread(search_backend.hybrid_search, vector, parsed, page=page, limit=25,
+                                                   group_sets=group_sets, cursor=cursor)
+            elif neural:
+                vector = await get_query_embedding(request, query)
+                response = await asyncio.to_thread(search_backend.vector_search, vector, page=page, limit=25,
+                                                   cursor=cursor)
             else:
-                search_task = model_worker.tag_search.apply_async(args=[split_tags], kwargs={"page": page, "limit": 25, "group_sets": group_sets}, priority=10)
-                search_task.wait()
-                results = search_task.get()
+                search_task = model_worker.tag_search.apply_async(args=[split_tags], kwargs={"page": page, "limit": 25, "group_sets": group_sets, "cursor": cursor}, priority=10)
+                response = await wait_for_result(search_task, SEARCH_TIMEOUT, request)
+
+            if response["next"]:
+                kind = "hybrid" if hybrid else "neural" if neural else "tags"
+                await warm_next_page(kind, response["next"], query=query, group_sets=group_sets)
 
             return templates.TemplateResponse("search.html",
-                                              {"request": request, "results": results, "page": page, "query": query,
-                                               "neural": neural, "group_sets": group_sets,
-                                               "time": time.time() - start_time})
+                                              {"request": request, "results": response["results"], "page": page,
+                                               "query": query, "neural": neural, "hybrid": hybrid,
+                                               "group_sets": group_sets,
+                                               "next_cursor": response["next"], "time": time.time() - start_time})
     else:
         return templates.TemplateResponse("search.html", {"request": request})
 
 
 @app.get("/stats")
 async def stats(request: Request):
-    total_images = await artwork_collection.count_documents({})
-    total_translations = await translation_collection.count_documents({})
-    total_sets = await artwork_collection.count_documents({"$or": [{"page_no": {"$exists": False}}, {"page_no": 0}]})
-
-    top_tags = await artwork_collection.aggregate([
-        {"$unwind": "$tags"},
-        {"$group": {
-            "_id": "$tags",
-            "count": {"$sum": 1}
-        }},
-        {"$sort": {"count": -1}}
-    ]).to_list(25)
+    totals = await stats_collection.find_one({"_id": "totals"})
+    if totals is None:
+        # Nothing recorded yet (fresh install or upgrade), build the stats in the background, once for all viewers
+        if await redis_conn.async_redis_client.set("stats:reconciling", 1, nx=True, ex=STATS_RECONCILE_LOCK_SECONDS):
+            tasks.reconcile_stats.delay()
+        totals = {}
+
+    top_tags = await tag_stats_collection.find().sort("count", -1).limit(25).to_list(25)
     top_tags = [{"tag": tag["_id"], "count": tag["count"]} for tag in top_tags]
 
-    tag_count = (await artwork_collection.aggregate([
-        {"$unwind": "$tags"},
-        {"$group": {
-            "_id": "$tags"
-        }},
-        {"$group": {
-            "_id": None,
-            "uniqueTagCount": {"$sum": 1}
-        }},
-        {"$project": {
-            "_id": 0,
-            "uniqueTagCount": 1
-        }}
-    ]).to_list(1))[0]["uniqueTagCount"]
-
-    artist_count = (await artwork_collection.aggregate([
-        {"$group": {
-            "_id": "$author_name"
-        }},
-        {"$group": {
-            "_id": None,
-            "uniqueArtistCount": {"$sum": 1}
-        }},
-        {"$project": {
-            "_id": 0,
-            "uniqueArtistCount": 1
-        }}
-    ]).to_list(1))[0]["uniqueArtistCount"]
-
     return templates.TemplateResponse("stats.html",
-                                      {"request": request, "total_images": total_images, "total_sets": total_sets,
-                                       "top_tags": top_tags, "total_translations": total_translations, "total_tags": tag_count, "total_artists": artist_count})
+                                      {"request": request, "total_images": totals.get("images", 0), "total_sets": totals.get("sets", 0),
+                                       "top_tags": top_tags, "total_translations": totals.get("translations", 0), "total_tags": totals.get("tags", 0), "total_artists": totals.get("artists", 0)})
 
 
 @app.post("/api/translate")
 async def translate_artwork(
+        request: Request,
         payload: Any = Body(None),
 ):
     if not payload:
         return {"message": "No payload."}
     image_id = payload["image_id"]
     task = tasks.translate_image_metadata.delay(image_id)
-    task.wait()
+    await wait_for_result(task, TRANSLATE_TIMEOUT, request)
 
     return {"message": "Translated artwork."}
 
@@ -261,8 +334,58 @@ async def index_missing_images():
     return {"message": "Indexing missing images."}
 
 
+@app.post("/api/migrateembeddings")
+async def migrate_embeddings():
+    model_worker.migrate_embeddings.delay()
+    return {"message": "Migrating embeddings to Qdrant."}
+
+
+@app.post("/api/backfillpayload")
+async def backfill_qdrant_payload():
+    model_worker.backfill_qdrant_payload.delay()
+    return {"message": "Backfilling the vector payload."}
+
+
+@app.post("/api/sweepduplicates")
+async def sweep_duplicates():
+    model_worker.sweep_duplicates.delay()
+    return {"message": "Sweeping for duplicates."}
+
+
+@app.post("/api/refreshsimilar")
+async def refresh_similar():
+    model_worker.refresh_similar.delay()
+    return {"message": "Refreshing similar artworks."}
+
+
+@app.post("/api/rebuildcollection")
+async def rebuild_collection():
+    model_worker.rebuild_qdrant_collection.delay()
+    return {"message": "Rebuilding the vector collection."}
+
+
+@app.post("/api/importgelbooru")
+async def import_gelbooru(payload: Any = Body(None)):
+    if not payload or not payload.get("tag"):
+        return {"message": "No tag given."}
+    tasks.import_gelbooru.delay(payload["tag"], max_posts=payload.get("max_posts"))
+    return {"message": "Importing from Gelbooru."}
+
+
+@app.get("/api/importgelbooru")
+async def import_gelbooru_status(tag: str):
+    checkpoint = await db.get_collection("import_checkpoints").find_one({"_id": tasks.gelbooru_checkpoint_id(tag.split(" "))})
+    if not checkpoint:
+        raise HTTPException(status_code=404, detail="No import for this tag")
+    return {key: checkpoint.get(key) for key in ("imported", "skipped", "before_id", "done")} | \
+        {"failed": [post["id"] for post in checkpoint.get("retry", [])]}
+
+
 @app.post("/api/deletebroken")
-async def delete_broken_art():
+async def delete_broken_art(dry_run: bool = False):
+    if dry_run:
+        task = tasks.scan_integrity.delay(dry_run=True)
+        return {"message": "Scanning for broken images.", "task_id": task.id}
     tasks.delete_broken_art.delay()
     return {"message": "Deleting broken images."}
 
@@ -272,8 +395,53 @@ async def delete_videos():
     tasks.delete_videos.delay()
     return {"message": "Deleting videos."}
 
+
+@app.get("/api/maintenance")
+async def maintenance_status():
+    jobs = await db.get_collection(maintenance.JOBS_COLLECTION).find().to_list(None)
+    return {job["_id"]: {key: job.get(key) for key in ("status", "processed", "total", "changed", "started_at",
+                                                       "finished_at")} for job in jobs}
+
+
 @app.post("/api/clearcache")
-async def clear_cache():
-    redis = redis_conn.redis_client
-    redis.flushdb()
+async def clear_cache(variant: str = None, image_id: str = None):
+    if variant is not None and variant not in image_proxy.VARIANTS:
+        raise HTTPException(status_code=400, detail="Unknown variant")
+    if image_id is not None and not is_image_id(image_id):
+        raise HTTPException(status_code=400, detail="Invalid image ID")
+    # Only the image cache, Celery results share the Redis database
+    await image_cache.clear(variant=variant, image_id=image_id)
     return {"message": "Cleared cache."}
+
+
+@app.get("/api/cachestats")
+async def cache_stats():
+    return image_cache.stats() | {"warming": await image_cache.warm_stats()}
+
+
+@app.get("/api/modelstatus")
+async def model_status():
+    workers = await redis_conn.async_redis_client.hgetall(model_worker.MODEL_READY_KEY)
+    return {hostname.decode("utf-8"): json.loads(report) for hostname, report in workers.items()}
+
+
+@app.post("/api/benchmarkmodel")
+async def benchmark_model():
+    # Takes many minutes on CPU nodes, the report is read with GET once it's done
+    task = model_worker.benchmark_inference.delay()
+    return {"message": "Benchmarking the model worker.", "task_id": task.id}
+
+
+@app.get("/api/benchmarkmodel")
+async def benchmark_model_result(task_id: str):
+    result = model_worker.app.AsyncResult(task_id)
+    if not await asyncio.to_thread(result.ready):
+        return {"status": result.state}
+    if result.failed():
+        raise HTTPException(status_code=500, detail=f"Benchmark failed: {result.result}")
+    return {"status": result.state, "report": result.result}
+
+
+@app.get("/api/uploadstats")
+async def upload_stats():
+    return await asyncio.to_thread(s3.upload_stats)
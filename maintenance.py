@@ -0,0 +1,70 @@
+import time
+
+from qdrant_client.models import PointIdsList
+
+import stats
+from neighbours import forget_neighbours
+from vector_store import get_qdrant_instance, point_id, record_changes, COLLECTION_NAME
+
+# Progress and resume points of the bulk maintenance jobs, one document per job name
+JOBS_COLLECTION = "maintenance_jobs"
+
+
+def run_job(db, name, query, projection, process_chunk, chunk_size=1000):
+    """
+    Runs a chunked maintenance pass over the artworks matching query.
+
+    The filter runs inside Mongo and documents are walked in _id order, chunk_size at a time, with only the
+    projected fields. process_chunk(db, documents) handles one chunk with bulk operations and returns how many
+    documents it changed. The last finished _id is checkpointed after every chunk, so an interrupted job resumes
+    where it stopped the next time it runs.
+    """
+    jobs = db.get_collection(JOBS_COLLECTION)
+    artwork_collection = db.get_collection("artwork")
+
+    job = jobs.find_one({"_id": name})
+    if not job or job.get("status") != "running":
+        job = {"_id": name, "status": "running", "last_id": None, "processed": 0, "changed": 0,
+               "total": artwork_collection.count_documents(query), "started_at": int(time.time())}
+        jobs.replace_one({"_id": name}, job, upsert=True)
+    else:
+        print(f"Resuming {name} after {job['last_id']}")
+
+    while True:
+        chunk_query = dict(query)
+        if job["last_id"] is not None:
+            chunk_query["_id"] = {"$gt": job["last_id"]}
+
+        documents = list(artwork_collection.find(chunk_query, projection).sort("_id", 1).limit(chunk_size))
+        if not documents:
+            break
+
+        changed = process_chunk(db, documents)
+
+        job["last_id"] = documents[-1]["_id"]
+        job["processed"] += len(documents)
+        job["changed"] += changed or 0
+        jobs.update_one({"_id": name}, {"$set": {"last_id": job["last_id"], "processed": job["processed"],
+                                                  "changed": job["changed"]}})
+        print(f"{name}: {job['processed']}/{job['total']} processed, {job['changed']} changed")
+
+    jobs.update_one({"_id": name}, {"$set": {"status": "done", "finished_at": int(time.time())}})
+    return {"processed": job["processed"], "changed": job["changed"]}
+
+
+def delete_artworks(db, artworks):
+    """Bulk deletes artworks from Mongo, Qdrant and the translations, and updates the statistics."""
+    artworks = list(artworks)
+    if not artworks:
+        return 0
+
+    image_ids = [artwork["_id"] for artwork in artworks]
+    record_changes(image_ids)
+    deleted = db.get_collection("artwork").delete_many({"_id": {"$in": image_ids}}).deleted_count
+    translations = db.get_collection("translations").delete_many({"_id": {"$in": image_ids}}).deleted_count
+    get_qdrant_instance().delete(COLLECTION_NAME, points_selector=PointIdsList(points=[point_id(image_id) for image_id in image_ids]))
+    forget_neighbours(db, image_ids)
+
+    stats.record_artworks_removed(db, artworks)
+    stats.record_translations_added(db, -translations)
+    return deleted
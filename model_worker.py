@@ -1,254 +1,463 @@
-import hashlib
+import json
+import socket
 import tempfile
-import uuid
-from threading import Lock
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import celery
-import requests
 from celery import Celery
-from pymongo import MongoClient
-from qdrant_client import QdrantClient
-from triton._C.libtriton.triton.ir import value
+from celery.signals import worker_init, worker_shutdown
+from pymongo import UpdateOne
 
 import config
+import redis_conn
 import s3
-from database import CONNECTION_STRING, Artwork
-
-import torch
-from PIL import Image
-import open_clip
-from qdrant_client.models import VectorParams, Distance, PointStruct, Filter, FieldCondition, MatchText, IsNullCondition, MatchValue, PayloadField
+import search
+from database import Artwork, get_sync_database
+from duplicates import find_duplicates, link_duplicates
+from neighbours import compute_neighbours, stale_neighbour_lists
+from ingest_io import download_to_file
+from maintenance import run_job, JOBS_COLLECTION
+from embedding_cache import text_embedding_cache, normalize_query
+import vector_store
+from vector_store import get_qdrant_instance, build_point, point_id, COLLECTION_NAME, EMBEDDING_VERSION
+
+from qdrant_client.models import SetPayload, SetPayloadOperation
 from kombu import Exchange, Queue
 
 
 app = Celery('model_worker', broker=config.CELERY_RABBITMQ_URL, backend=config.REDIS_URL, result_expires=60 * 60 * 24)
-app.conf.task_default_queue = 'model_worker'
+# Inference batches and query/bookkeeping tasks have separate queues, so searches never wait behind an embedding
+# backfill. Interactive tasks default to priority 10, background work to 0.
+INFERENCE_QUEUE = 'model_worker'
+QUERY_QUEUE = 'model_queries'
+INTERACTIVE_PRIORITY = 10
+BACKGROUND_PRIORITY = 0
+
+app.conf.task_default_queue = INFERENCE_QUEUE
 app.conf.task_queues = [
-    Queue('model_worker', routing_key='model_tasks.#', queue_arguments={'x-max-priority': 10}, max_priority=10),
+    Queue(INFERENCE_QUEUE, routing_key='model_tasks.#', queue_arguments={'x-max-priority': 10}, max_priority=10),
+    Queue(QUERY_QUEUE, routing_key='model_queries.#', queue_arguments={'x-max-priority': 10}, max_priority=10),
 ]
 app.conf.update(
     worker_prefetch_multiplier=1
 )
 
-model, preprocess, tokenizer, qdrant_client = None, None, None, None
-loadingMutex = Lock()
+# torch and the model only live in inference.py, which is imported lazily: the web app and the task worker import
+# this module for its task signatures and must not pay for loading torch.
+
+# Hash of worker hostname -> load report, written once the model is loaded and the worker can serve requests
+MODEL_READY_KEY = "model_worker:ready"
 
-def load_model():
-    global model, preprocess, tokenizer
-    model, _, preprocess = open_clip.create_model_and_transforms(config.VIT_MODEL_NAME, pretrained=config.VIT_MODEL_PRETRAINED)
-    tokenizer = open_clip.get_tokenizer('ViT-B-32')
-    model.to(config.VIT_DEVICE)
-    print("Model loaded")
+# Image IDs waiting for an embedding batch are kept in a Redis list, so a single batch task can pick up
+# everything that was queued while the previous batch was running.
+EMBEDDING_PENDING_KEY = "embeddings:pending"
+EMBEDDING_SCHEDULED_KEY = "embeddings:scheduled"
+EMBEDDING_BATCH_SIZE = getattr(config, "EMBEDDING_BATCH_SIZE", 32)
+# Seconds to wait for more IDs when a batch is not full yet
+EMBEDDING_BATCH_DEADLINE = getattr(config, "EMBEDDING_BATCH_DEADLINE", 2)
+EMBEDDING_PREFETCH_WORKERS = getattr(config, "EMBEDDING_PREFETCH_WORKERS", 8)
 
 
 def get_model_instances():
-    with loadingMutex:
-        if model is None:
-            load_model()
-        return model, preprocess, tokenizer
-
-
-
-def get_qdrant_instance():
-    global qdrant_client
-    if qdrant_client is None:
-        qdrant_client = QdrantClient(config.QDRANT_HOST)
-        if not qdrant_client.collection_exists("vit_embeddings"):
-            qdrant_client.create_collection("vit_embeddings", VectorParams(size=1024, distance=Distance.COSINE))
-            qdrant_client.create_payload_index("vit_embeddings", "tags", "keyword")
-            qdrant_client.create_payload_index("vit_embeddings", "page_no", "integer")
-            qdrant_client.create_payload_index("vit_embeddings", "added_at", "integer")
-        return qdrant_client
-    return qdrant_client
-
-@app.task()
-def index_embedding_qdrant(image_ids):
-    with MongoClient(CONNECTION_STRING) as connection:
-        db = connection.get_database("supaarchive")
-        artwork_collection = db.get_collection("artwork")
-
-        artworks = artwork_collection.find({"_id": {"$in": image_ids}, "vitEmbedding": {"$ne": None}})
-
-        records = []
-        for artwork in artworks:
-            if artwork["vitEmbedding"] is not None:
-                hash = hashlib.sha256()
-                hash.update(artwork["_id"].encode("utf-8"))
-                internal_id = uuid.UUID(hash.hexdigest()[:32]).hex
-
-                records.append({
-                    "internal_id": internal_id,
-                    "vector": artwork["vitEmbedding"],
-                    "payload": {
-                        "image_id": artwork["_id"],
-                        "tags": artwork["tags"],
-                        "title": artwork["title"],
-                        "page_no": artwork["page_no"],
-                    }
-                })
-
-        if len(records) == 0:
-            raise ValueError("No records to upload")
-
-        qdrant_client = get_qdrant_instance()
-        qdrant_client.upload_points("vit_embeddings", points=[
-            PointStruct(id=doc["internal_id"], vector=doc["vector"], payload=doc["payload"])
-            for idx, doc in enumerate(records)
-        ])
+    import inference
+    return inference.get_model_instances()
 
 
-@app.task()
-def generate_embeddings(image_id):
-    with MongoClient(CONNECTION_STRING) as connection:
-        db = connection.get_database("supaarchive")
-        artwork_collection = db.get_collection("artwork")
+@worker_init.connect
+def load_model_on_start(sender=None, **kwargs):
+    """Loads the model before the worker consumes anything, so the first search after a deploy isn't a cold start."""
+    # The task worker imports this module as well
+    if sender.app.main != app.main:
+        return
+
+    import inference
+    get_model_instances()
+    # Create the collection for whatever size this model outputs
+    vector_store.ensure_collection(get_qdrant_instance(), inference.embedding_dimension())
+
+    redis_conn.redis_client.hset(MODEL_READY_KEY, sender.hostname or socket.gethostname(),
+                                 json.dumps(inference.load_report | {"ready_at": int(time.time())}))
+
+    # Artworks from before the embedding_version marker would show as unembedded until migrated. Once the job is
+    # done nothing is looked up, no index covers a missing field. An unfinished job resumes from its checkpoint.
+    job = get_sync_database().get_collection(JOBS_COLLECTION).find_one({"_id": "migrate_embeddings"}, {"status": 1})
+    if not job or job.get("status") != "done":
+        migrate_embeddings.delay()
+
+
+@worker_shutdown.connect
+def clear_ready(sender=None, **kwargs):
+    if sender is not None and getattr(sender, "app", None) is not None and sender.app.main == app.main:
+        redis_conn.redis_client.hdel(MODEL_READY_KEY, sender.hostname or socket.gethostname())
 
-        artwork = artwork_collection.find_one({"_id": image_id})
 
-        if not artwork:
-            raise ValueError("Artwork not found")
+def enqueue_embeddings(image_ids, countdown=0):
+    """Adds image IDs to the pending embedding list and makes sure a batch task is scheduled to pick them up."""
+    if not image_ids:
+        return
 
-        model, preprocess, tokenizer = get_model_instances()
+    redis = redis_conn.redis_client
+    redis.rpush(EMBEDDING_PENDING_KEY, *image_ids)
 
-        # Download image
+    # Only one batch task needs to be in flight, it re-schedules itself while IDs remain.
+    # The flag expires so that a lost task can't stall the queue forever.
+    if redis.set(EMBEDDING_SCHEDULED_KEY, 1, nx=True, ex=60 * 10):
+        generate_embeddings_batch.apply_async(countdown=countdown)
+
+
+def collect_pending_batch(batch_size=EMBEDDING_BATCH_SIZE, deadline=EMBEDDING_BATCH_DEADLINE):
+    """Pops up to batch_size image IDs, waiting at most deadline seconds for a partial batch to fill up."""
+    redis = redis_conn.redis_client
+    image_ids = []
+    deadline_at = time.monotonic() + deadline
+
+    while len(image_ids) < batch_size:
+        popped = redis.lpop(EMBEDDING_PENDING_KEY, batch_size - len(image_ids))
+        if popped:
+            image_ids.extend(popped)
+            continue
+
+        remaining = deadline_at - time.monotonic()
+        # Nothing pending at all, there is no batch to wait for
+        if not image_ids or remaining <= 0:
+            break
+
+        popped = redis.blpop([EMBEDDING_PENDING_KEY], timeout=remaining)
+        if popped is None:
+            break
+        image_ids.append(popped[1])
+
+    # Drop duplicates, but keep the queue order
+    return list(dict.fromkeys(image_id.decode("utf-8") if isinstance(image_id, bytes) else image_id
+                              for image_id in image_ids))
+
+
+def prepare_image(artwork, preprocess):
+    """Downloads and preprocesses a single image, returns None if it can't be used."""
+    import inference
+    try:
         with tempfile.TemporaryFile() as temp:
-            res = requests.get(f"{s3.base_url}{artwork['s3_object_name']}")
-            temp.write(res.content)
-            print("Downloading {0} to {1}".format(res.url, temp.name))
-            temp.seek(0)
+            download_to_file(f"{s3.base_url}{artwork['s3_object_name']}", temp)
+            content = temp.read()
+
+        return inference.preprocess_image(content, preprocess)
+    except Exception as e:
+        print("Failed to prepare {0}: {1}".format(artwork["_id"], e))
+        return None
 
-            image = preprocess(Image.open(temp)).unsqueeze(0).to(config.VIT_DEVICE)
-            text = tokenizer(", ".join(artwork["tags"])).to(config.VIT_DEVICE)
 
-            print("Image and text prepared")
+def embed_images(image_ids):
+    """Generates embeddings for a batch of images in one forward pass and stores them in Mongo and Qdrant."""
+    start_time = time.time()
 
-            # generate embeddings
-            with torch.no_grad(), torch.cuda.amp.autocast():
-                print("Running inference")
-                image_features = model.encode_image(image)
-                text_features = model.encode_text(text)
+    db = get_sync_database()
+    artwork_collection = db.get_collection("artwork")
 
-                image_features /= image_features.norm(dim=-1, keepdim=True)
-                text_features /= text_features.norm(dim=-1, keepdim=True)
+    artworks = list(artwork_collection.find({"_id": {"$in": image_ids}},
+                                            {"s3_object_name": 1, "tags": 1, "title": 1, "page_no": 1, "pixiv_source_id": 1,
+                                             "author_name": 1}))
+    if not artworks:
+        return {"embedded": 0, "failed": len(image_ids), "seconds": 0, "images_per_second": 0}
 
+    import inference
+    model, preprocess, tokenizer = get_model_instances()
 
-            print("Image features shape: {0}".format(image_features.shape))
+    inference_batch = inference.VIT_INFERENCE_BATCH or len(artworks)
+    ready, vectors, chunk = [], [], []
+
+    def encode_chunk():
+        vectors.extend(inference.encode_images([image for _, image in chunk]))
+        ready.extend(chunk)
+        chunk.clear()
+
+    # Downloads and PIL transforms are I/O and C-bound, so a thread pool keeps the model fed. map() submits every
+    # image up front, later images are prepared while the earlier chunks run through the model.
+    with ThreadPoolExecutor(max_workers=EMBEDDING_PREFETCH_WORKERS) as pool:
+        for artwork, image in zip(artworks, pool.map(lambda artwork: prepare_image(artwork, preprocess), artworks)):
+            if image is None:
+                continue
+            chunk.append((artwork, image))
+            if len(chunk) >= inference_batch:
+                encode_chunk()
+        if chunk:
+            encode_chunk()
+
+    if not ready:
+        return {"embedded": 0, "failed": len(image_ids), "seconds": time.time() - start_time,
+                "images_per_second": 0}
+
+    # Re-encoded or resized copies of an indexed image are linked to it instead of getting their own point
+    qdrant_client = get_qdrant_instance()
+    matches = find_duplicates(qdrant_client, [(artwork, vector) for (artwork, _), vector in zip(ready, vectors)])
+    duplicates = {artwork["_id"]: match[0] for (artwork, _), match in zip(ready, matches) if match}
+
+    # Qdrant first, so an artwork is never marked as embedded without a vector to back it
+    points = [build_point(artwork, vector) for (artwork, _), vector in zip(ready, vectors)
+              if artwork["_id"] not in duplicates]
+    vector_store.record_changes([artwork["_id"] for artwork, _ in ready])
+    if points:
+        qdrant_client.upsert(COLLECTION_NAME, points=points)
+
+    artwork_collection.bulk_write([
+        UpdateOne({"_id": artwork["_id"]}, {"$set": {"embedding_version": EMBEDDING_VERSION}})
+        for artwork, _ in ready
+    ], ordered=False)
+    link_duplicates(db, qdrant_client, duplicates)
+    if points:
+        compute_similar.delay([point.payload["image_id"] for point in points])
+
+    elapsed = time.time() - start_time
+    report = {
+        "embedded": len(ready),
+        "duplicates": len(duplicates),
+        "failed": len(image_ids) - len(ready),
+        "seconds": elapsed,
+        "images_per_second": len(ready) / elapsed if elapsed > 0 else 0,
+    }
+    print("Embedded {embedded} images ({duplicates} duplicates, {failed} failed) in {seconds:.2f}s, {images_per_second:.2f} images/sec".format(**report))
+    return report
+
+
+@app.task(priority=BACKGROUND_PRIORITY)
+def generate_embeddings_batch():
+    redis = redis_conn.redis_client
+    if vector_store.rebuild_in_progress():
+        # Keep the flag, so ingest doesn't schedule more batches, and check again later
+        redis.expire(EMBEDDING_SCHEDULED_KEY, 60 * 10)
+        generate_embeddings_batch.apply_async(countdown=30)
+        return
+
+    # Clear the flag before draining, anything enqueued after this point schedules a new batch
+    redis.delete(EMBEDDING_SCHEDULED_KEY)
+
+    image_ids = collect_pending_batch()
+    if not image_ids:
+        return
+
+    countdown = 0
+    try:
+        return embed_images(image_ids)
+    except Exception:
+        # Back to the front of the queue, and give whatever failed (Qdrant, Mongo) a moment before the retry
+        redis.lpush(EMBEDDING_PENDING_KEY, *reversed(image_ids))
+        countdown = 30
+        raise
+    finally:
+        if redis.llen(EMBEDDING_PENDING_KEY) > 0 and redis.set(EMBEDDING_SCHEDULED_KEY, 1, nx=True, ex=60 * 10):
+            generate_embeddings_batch.apply_async(countdown=countdown)
+
+
+@app.task(queue=QUERY_QUEUE, priority=BACKGROUND_PRIORITY)
+def generate_embeddings(image_id):
+    enqueue_embeddings([image_id])
 
-            artwork_collection.update_one({"_id": image_id}, {"$set": {"vitEmbedding": image_features.cpu().numpy().tolist()[0]}})
 
-            index_embedding_qdrant.delay([image_id])
+def enqueue_chunk(db, artworks):
+    image_ids = [artwork["_id"] for artwork in artworks]
+    enqueue_embeddings(image_ids)
+    return len(image_ids)
 
 
-@app.task()
+@app.task(queue=QUERY_QUEUE, priority=BACKGROUND_PRIORITY)
 def index_missing_images():
-    with MongoClient(CONNECTION_STRING) as connection:
-        db = connection.get_database("supaarchive")
-        artwork_collection = db.get_collection("artwork")
+    # Served by the embedding_version_missing partial index, only the IDs are read
+    return run_job(get_sync_database(), "index_missing_images", {"embedding_version": {"$type": "null"}}, {"_id": 1},
+                   enqueue_chunk)
 
-        artworks = artwork_collection.find({"vitEmbedding": None})
 
-        for artwork in artworks:
-            generate_embeddings.delay(artwork["_id"])
+@app.task(queue=QUERY_QUEUE, priority=INTERACTIVE_PRIORITY)
+def get_similar(image_id, limit=25):
+    return search.similar_artworks(image_id, limit=limit)
 
 
-@app.task()
-def get_similar(image_id, limit=25):
-    with MongoClient(CONNECTION_STRING) as connection:
-        db = connection.get_database("supaarchive")
-        artwork_collection = db.get_collection("artwork")
+@app.task(queue=QUERY_QUEUE, priority=BACKGROUND_PRIORITY)
+def compute_similar(image_ids):
+    """Precomputes the similar artworks lists of newly indexed artworks and merges them into existing lists."""
+    return compute_neighbours(get_sync_database(), get_qdrant_instance(), image_ids)
 
-        artwork = artwork_collection.find_one({"_id": image_id})
 
-        if not artwork:
-            return
+def refresh_similar_chunk(db, artworks):
+    stale = stale_neighbour_lists(db, [artwork["_id"] for artwork in artworks])
+    if not stale:
+        return 0
+    return compute_neighbours(db, get_qdrant_instance(), stale)
 
-        qdrant_client = get_qdrant_instance()
-        artwork = qdrant_client.search("vit_embeddings", query_vector=artwork["vitEmbedding"], limit=limit+5, with_payload=True)
-        # Drop searched-for ID from results
-        artwork = [res for res in artwork if res.payload["image_id"] != image_id]
-        # Drop results that have the same pixiv_source_id as the searched-for ID (would probably all match, observed >0.95 filling all results).
-        # Pixiv ID of 0 = not set
-        artwork = [res for res in artwork if artwork_collection.find_one({"_id": res.payload["image_id"]})["pixiv_source_id"] != artwork_collection.find_one({"_id": image_id})["pixiv_source_id"]]
-        # Limit to "limit" results
-        artwork = artwork[:limit]
 
-        hydrated_artwork = []
-        for res in artwork:
-            dbgArtwork = artwork_collection.find_one({"_id": res.payload["image_id"]})
-            print("{0} - {1} -> {2}: {3}".format(res.score, res.payload["image_id"], res.payload["tags"], s3.base_url + dbgArtwork["s3_object_name"]).encode("utf-8"))
-            hydrated_artwork.append(dbgArtwork | {"score": res.score})
+@app.task(queue=QUERY_QUEUE, priority=BACKGROUND_PRIORITY)
+def refresh_similar(batch_size=256):
+    """Recomputes missing, outdated (other embedding version) and incomplete similar artworks lists."""
+    return run_job(get_sync_database(), "refresh_similar", {"embedding_version": {"$ne": None}, "duplicate_of": None},
+                   {"_id": 1}, refresh_similar_chunk, chunk_size=batch_size)
 
-        return hydrated_artwork
 
+def encode_text(query):
+    """Returns the normalized text embedding for a query, served from the embedding cache where possible."""
+    vector = text_embedding_cache.get(query)
+    if vector is not None:
+        return vector
+
+    import inference
+    vector = inference.encode_texts([normalize_query(query)])[0]
+    text_embedding_cache.set(query, vector)
+    return vector
 
-@app.task()
-def neural_search(tags, page=1, limit=25):
-    model, preprocess, tokenizer = get_model_instances()
 
-    text = tokenizer(tags).to(config.VIT_DEVICE)
+@app.task(queue=QUERY_QUEUE, priority=INTERACTIVE_PRIORITY)
+def encode_query(query):
+    return encode_text(query)
 
-    # generate embeddings
-    with torch.no_grad(), torch.cuda.amp.autocast():
-        print("Running inference")
-        text_features = model.encode_text(text)
 
-        text_features /= text_features.norm(dim=-1, keepdim=True)
+@app.task(queue=QUERY_QUEUE, priority=INTERACTIVE_PRIORITY)
+def neural_search(tags, page=1, limit=25, cursor=None):
+    return search.vector_search(encode_text(tags), page=page, limit=limit, cursor=cursor)
 
-        qdrant_client = get_qdrant_instance()
 
-        results = qdrant_client.search("vit_embeddings", query_vector=text_features.cpu().numpy().tolist()[0], limit=limit*page, with_payload=True)
+@app.task(queue=QUERY_QUEUE, priority=INTERACTIVE_PRIORITY)
+def tag_search(tags, page=1, limit=25, group_sets=True, cursor=None):
+    return search.tag_search(tags, page=page, limit=limit, group_sets=group_sets, cursor=cursor)
 
-        # Only return the requested page
-        results = results[(page-1)*limit:page*limit]
 
-        hydrated_artwork = []
-        with MongoClient(CONNECTION_STRING) as connection:
-            db = connection.get_database("supaarchive")
-            artwork_collection = db.get_collection("artwork")
-            for res in results:
-                artwork = artwork_collection.find_one({"_id": res.payload["image_id"]})
-                hydrated_artwork.append(artwork | {"score": res.score})
-        return hydrated_artwork
+@app.task(queue=QUERY_QUEUE, priority=BACKGROUND_PRIORITY)
+def sync_merged_payloads(image_ids):
+    """
+    Copies tags and source IDs merged into already indexed artworks onto their points, search filters on the payload.
+    Artworks without a point yet get the merged fields when they are embedded.
+    """
+    artworks = list(get_sync_database().get_collection("artwork").find(
+        {"_id": {"$in": image_ids}, "embedding_version": {"$ne": None}, "duplicate_of": None},
+        {"tags": 1, "pixiv_source_id": 1}))
+    if not artworks:
+        return 0
 
+    vector_store.record_changes([artwork["_id"] for artwork in artworks])
+    get_qdrant_instance().batch_update_points(COLLECTION_NAME, update_operations=[
+        SetPayloadOperation(set_payload=SetPayload(payload={"tags": artwork["tags"],
+                                                            "pixiv_source_id": artwork.get("pixiv_source_id")},
+                                                   points=[point_id(artwork["_id"])]))
+        for artwork in artworks
+    ])
+    return len(artworks)
 
-@app.task()
-def tag_search(tags, page=1, limit=25, group_sets=True):
-    print("page: {0}, limit: {1}".format(page, limit))
+
+@app.task(queue=QUERY_QUEUE, priority=BACKGROUND_PRIORITY)
+def backfill_qdrant_payload(batch_size=256):
+    """Copies payload fields added after the first indexing run (pixiv_source_id, author_name) onto existing points."""
+    # The payload indexes themselves are added by ensure_collection when the worker starts
     qdrant_client = get_qdrant_instance()
 
-    offset_id = None
+    def set_payloads(db, artworks):
+        vector_store.record_changes([artwork["_id"] for artwork in artworks])
+        qdrant_client.batch_update_points(COLLECTION_NAME, update_operations=[
+            SetPayloadOperation(set_payload=SetPayload(payload={"pixiv_source_id": artwork.get("pixiv_source_id"),
+                                                                "author_name": artwork.get("author_name")},
+                                                       points=[point_id(artwork["_id"])]))
+            for artwork in artworks
+        ])
+        return len(artworks)
+
+    # Duplicates have no point, a single missing ID would fail the whole batch update
+    updated = run_job(get_sync_database(), "backfill_qdrant_payload",
+                      {"embedding_version": {"$ne": None}, "duplicate_of": None},
+                      {"pixiv_source_id": 1, "author_name": 1}, set_payloads, chunk_size=batch_size)["changed"]
+
+    print("Backfilled payload of {0} points".format(updated))
+    return updated
+
 
-    img_filter = Filter(
-        must=[
-            FieldCondition(key="tags", match=MatchValue(value=tag))
-            for _, tag in enumerate(tags)
-        ],
-        should=[
-            FieldCondition(key="page_no", match=MatchValue(value=0)),
-            IsNullCondition(is_null=PayloadField(key="page_no"))
-        ] if group_sets else []
-    )
+def migrate_embedding_chunk(db, artworks):
+    points = [build_point(artwork, artwork["vitEmbedding"]) for artwork in artworks if artwork.get("vitEmbedding")]
+    vector_store.record_changes([artwork["_id"] for artwork in artworks if artwork.get("vitEmbedding")])
+    if points:
+        get_qdrant_instance().upsert(COLLECTION_NAME, points=points)
 
-    print("Filter: {0}".format(img_filter))
+    db.get_collection("artwork").bulk_write([
+        UpdateOne({"_id": artwork["_id"]}, {
+            "$set": {"embedding_version": EMBEDDING_VERSION if artwork.get("vitEmbedding") else None},
+            "$unset": {"vitEmbedding": ""},
+        }) for artwork in artworks
+    ], ordered=False)
+    return len(points)
 
-    while page > 1:
-        _, next_page = qdrant_client.scroll("vit_embeddings", scroll_filter=img_filter, limit=limit, offset=offset_id)
-        print("Next page: {0} ({1} -> {2})".format(next_page, page, page-1))
-        if next_page is None:
-            page = 1
-        else:
-            offset_id = next_page
-        page -= 1
 
-    results = qdrant_client.scroll("vit_embeddings", scroll_filter=img_filter, limit=limit, offset=offset_id, with_payload=True)[0]
+@app.task(queue=QUERY_QUEUE, priority=BACKGROUND_PRIORITY)
+def migrate_embeddings(batch_size=256):
+    """
+    Moves embeddings stored as float lists in Mongo into Qdrant and replaces them with an embedding_version marker.
 
-    hydrated_artwork = []
-    with MongoClient(CONNECTION_STRING) as connection:
-        db = connection.get_database("supaarchive")
-        artwork_collection = db.get_collection("artwork")
-        for res in results:
-            hydrated_artwork.append(artwork_collection.find_one({"_id": res.payload["image_id"]}))
+    Artworks without an embedding get an explicit null marker, so index_missing_images picks them up.
+    """
+    return run_job(get_sync_database(), "migrate_embeddings", {"embedding_version": {"$exists": False}},
+                   {"vitEmbedding": 1, "tags": 1, "title": 1, "page_no": 1, "pixiv_source_id": 1, "author_name": 1},
+                   migrate_embedding_chunk, chunk_size=batch_size)
 
-    return hydrated_artwork
 
+@app.task(priority=BACKGROUND_PRIORITY)
+def rebuild_qdrant_collection():
+    """
+    Rebuilds the collection with the configured quantization, HNSW and storage settings.
 
+    Vectors are copied over if the model still outputs the same size, otherwise all artworks are re-embedded.
+    """
+    import inference
+    vector_size = inference.embedding_dimension()
+
+    qdrant_client = get_qdrant_instance()
+    current = vector_store.resolve_collection(qdrant_client)
+    same_size = current is not None and qdrant_client.get_collection(current).config.params.vectors.size == vector_size
+
+    result = vector_store.rebuild_collection(vector_size=vector_size, copy_vectors=same_size)
+    if not same_size:
+        get_sync_database().get_collection("artwork").update_many({"embedding_version": {"$ne": None}},
+                                                                  {"$set": {"embedding_version": None}})
+        index_missing_images.delay()
+    return result
+
+
+def sweep_duplicate_chunk(db, artworks):
+    qdrant_client = get_qdrant_instance()
+    points = {point.payload["image_id"]: point.vector for point in
+              qdrant_client.retrieve(COLLECTION_NAME, ids=[point_id(artwork["_id"]) for artwork in artworks],
+                                     with_payload=["image_id"], with_vectors=True)}
+    entries = [(artwork, points[artwork["_id"]]) for artwork in artworks if artwork["_id"] in points]
+    matches = find_duplicates(qdrant_client, entries, limit=5)
+
+    candidates = {image_id for match in matches for image_id in match}
+    added_at = {artwork["_id"]: artwork.get("added_at", 0) for artwork in
+                db.get_collection("artwork").find({"_id": {"$in": list(candidates)}}, {"added_at": 1})}
+
+    # The oldest copy stays, so every member of a cluster resolves to the same artwork
+    duplicates = {}
+    for (artwork, _), match in zip(entries, matches):
+        position = (artwork.get("added_at", 0), artwork["_id"])
+        older = [(added_at[image_id], image_id) for image_id in match
+                 if image_id in added_at and (added_at[image_id], image_id) < position]
+        if older:
+            duplicates[artwork["_id"]] = min(older)[1]
+
+    return link_duplicates(db, qdrant_client, duplicates)
+
+
+@app.task(queue=QUERY_QUEUE, priority=BACKGROUND_PRIORITY)
+def sweep_duplicates(batch_size=256):
+    """Finds near-duplicate clusters in the archive and links every copy to the oldest artwork of its cluster."""
+    return run_job(get_sync_database(), "sweep_duplicates",
+                   {"embedding_version": {"$ne": None}, "duplicate_of": None},
+                   {"added_at": 1, "pixiv_source_id": 1}, sweep_duplicate_chunk, chunk_size=batch_size)
+
+
+@app.task(queue=INFERENCE_QUEUE, priority=BACKGROUND_PRIORITY)
+def benchmark_inference():
+    """
+    Reports the model load time, text encode latency and images/sec per inference configuration of this worker.
+
+    Runs on the inference queue, so in split mode only the solo worker measures. In threads mode the image
+    benchmark holds the inference lock, queries wait instead of running on a reconfigured model.
+    """
+    import inference
+    get_model_instances()
+    report = inference.load_report | {"text_latency": inference.benchmark_text_latency(),
+                                      "image_throughput": inference.benchmark_image_throughput(),
+                                      "preprocessing": inference.benchmark_preprocessing()}
+    print("Benchmark: {0}".format(report))
+    return report
@@ -0,0 +1,77 @@
+import time
+
+from pymongo import UpdateOne
+from qdrant_client.models import SearchRequest
+
+import config
+from search import similar_filter
+from vector_store import point_id, search_params, COLLECTION_NAME, EMBEDDING_VERSION
+
+# Number of similar artworks kept per artwork, lists are stored with the embedding version they were computed from
+SIMILAR_LIMIT = getattr(config, "SIMILAR_LIMIT", 10)
+# Only what the image page renders, so a list can be served without touching the artwork collection
+NEIGHBOUR_PROJECTION = {"title": 1, "s3_object_name": 1}
+
+
+def compute_neighbours(db, qdrant_client, image_ids):
+    """
+    Computes and stores the nearest neighbours of the given (indexed) artworks with one batched Qdrant search.
+
+    Every new artwork is also pushed into the stored lists of the neighbours it found, if it ranks high enough there,
+    so existing lists stay current as art arrives without recomputing them.
+    """
+    points = qdrant_client.retrieve(COLLECTION_NAME, ids=[point_id(image_id) for image_id in image_ids],
+                                    with_payload=["image_id", "pixiv_source_id"], with_vectors=True)
+    if not points:
+        return 0
+
+    results = qdrant_client.search_batch(COLLECTION_NAME, requests=[
+        SearchRequest(vector=point.vector,
+                      filter=similar_filter(point.payload["image_id"], point.payload.get("pixiv_source_id")),
+                      limit=SIMILAR_LIMIT, with_payload=["image_id"], params=search_params())
+        for point in points
+    ])
+
+    image_ids = {hit.payload["image_id"] for hits in results for hit in hits} | \
+                {point.payload["image_id"] for point in points}
+    documents = {artwork["_id"]: artwork for artwork in
+                 db.get_collection("artwork").find({"_id": {"$in": list(image_ids)}}, NEIGHBOUR_PROJECTION)}
+
+    def entry(image_id, score):
+        return {"_id": image_id, "title": documents[image_id].get("title"),
+                "s3_object_name": documents[image_id]["s3_object_name"], "score": score}
+
+    computed_at = int(time.time())
+    operations = []
+    for point, hits in zip(points, results):
+        image_id = point.payload["image_id"]
+        neighbours = [entry(hit.payload["image_id"], hit.score) for hit in hits if hit.payload["image_id"] in documents]
+        operations.append(UpdateOne({"_id": image_id}, {"$set": {"neighbours": neighbours, "version": EMBEDDING_VERSION,
+                                                                 "computed_at": computed_at}}, upsert=True))
+        if image_id not in documents:
+            continue
+        # Cosine similarity is symmetric, $sort and $slice keep only the best SIMILAR_LIMIT
+        for hit in hits:
+            operations.append(UpdateOne(
+                {"_id": hit.payload["image_id"], "version": EMBEDDING_VERSION, "neighbours._id": {"$ne": image_id}},
+                {"$push": {"neighbours": {"$each": [entry(image_id, hit.score)], "$sort": {"score": -1},
+                                          "$slice": SIMILAR_LIMIT}}}))
+
+    db.get_collection("similar_artworks").bulk_write(operations, ordered=True)
+    return len(points)
+
+
+def stale_neighbour_lists(db, image_ids):
+    """Returns the image IDs whose stored list is missing, from another embedding version or not full."""
+    fresh = {document["_id"] for document in db.get_collection("similar_artworks").find(
+        {"_id": {"$in": image_ids}, "version": EMBEDDING_VERSION, f"neighbours.{SIMILAR_LIMIT - 1}": {"$exists": True}},
+        {"_id": 1})}
+    return [image_id for image_id in image_ids if image_id not in fresh]
+
+
+def forget_neighbours(db, image_ids):
+    """Drops the lists of removed artworks and takes them out of every other list."""
+    similar_collection = db.get_collection("similar_artworks")
+    similar_collection.delete_many({"_id": {"$in": image_ids}})
+    similar_collection.update_many({"neighbours._id": {"$in": image_ids}},
+                                   {"$pull": {"neighbours": {"_id": {"$in": image_ids}}}})
@@ -1,6 +1,9 @@
 import redis
+import redis.asyncio
 
 import config
 
 redis_client = redis.Redis.from_url(config.REDIS_URL)
 
+# For use inside async handlers, so cache lookups don't block the event loop
+async_redis_client = redis.asyncio.Redis.from_url(config.REDIS_URL)
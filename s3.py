@@ -1,20 +1,88 @@
+import os
+import time
+
 import boto3
 import botocore
 from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 
 import config
+import redis_conn
+
+S3_MAX_CONCURRENCY = getattr(config, "S3_MAX_CONCURRENCY", 10)
 
 s3 = boto3.resource('s3',
     endpoint_url = config.S3_ENDPOINT,
     aws_access_key_id = config.S3_KEY_ID,
     aws_secret_access_key = config.S3_SECRET_KEY,
+    # Enough pooled connections for every multipart thread
+    config = Config(max_pool_connections=S3_MAX_CONCURRENCY * 2),
 )
 
 bucket = config.S3_BUCKET
 base_url = config.S3_BASE_URL
 
+# Anything above the threshold is uploaded as parallel multipart chunks
+transfer_config = TransferConfig(
+    multipart_threshold=getattr(config, "S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024),
+    multipart_chunksize=getattr(config, "S3_MULTIPART_CHUNKSIZE", 8 * 1024 * 1024),
+    max_concurrency=S3_MAX_CONCURRENCY,
+    use_threads=True,
+)
+
+UPLOAD_STATS_KEY = "s3:uploadstats"
+
+
+def object_exists(name):
+    try:
+        s3.meta.client.head_object(Bucket=bucket, Key=name)
+        return True
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
 def upload_file(file, object_name, extension):
     name = object_name + "." + extension
-    s3.meta.client.upload_fileobj(file, bucket, name, ExtraArgs={'ACL':'public-read'})
+
+    # Keys are content hashes, if the object is there it is the same file
+    if object_exists(name):
+        print(f"{name} already in bucket, skipping upload")
+        redis_conn.redis_client.hincrby(UPLOAD_STATS_KEY, "skipped", 1)
+        return name
+
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+
+    start_time = time.time()
+    s3.meta.client.upload_fileobj(file, bucket, name, ExtraArgs={'ACL':'public-read'}, Config=transfer_config)
+    elapsed = time.time() - start_time
+
+    print(f"Uploaded {name}: {size / 1024 / 1024:.2f} MB in {elapsed:.2f}s ({size / 1024 / 1024 / max(elapsed, 0.001):.2f} MB/s)")
+    with redis_conn.redis_client.pipeline() as pipe:
+        pipe.hincrby(UPLOAD_STATS_KEY, "uploads", 1)
+        pipe.hincrby(UPLOAD_STATS_KEY, "bytes", size)
+        pipe.hincrbyfloat(UPLOAD_STATS_KEY, "seconds", elapsed)
+        pipe.execute()
 
     return name
+
+
+def upload_stats():
+    """Totals since the last reset, MB/s = bytes / seconds."""
+    stats = {field.decode("utf-8"): float(value) for field, value in redis_conn.redis_client.hgetall(UPLOAD_STATS_KEY).items()}
+    if stats.get("seconds"):
+        stats["megabytes_per_second"] = stats.get("bytes", 0) / 1024 / 1024 / stats["seconds"]
+    return stats
+
+
+def list_object_pages(prefix=""):
+    """
+    Yields the bucket listing one request at a time, as lists of up to 1000 (key, size) pairs instead of a HEAD per
+    object. list_objects_v2 returns keys in ascending (UTF-8 binary) order.
+    """
+    paginator = s3.meta.client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": 1000}):
+        yield [(obj["Key"], obj["Size"]) for obj in page.get("Contents", [])]
@@ -0,0 +1,331 @@
+import base64
+import json
+import shlex
+import time
+from threading import Lock
+
+from qdrant_client.models import Filter, FieldCondition, MatchValue, IsNullCondition, PayloadField
+
+import config
+from database import get_sync_database
+from vector_store import get_qdrant_instance, point_id, search_params, COLLECTION_NAME
+
+# Only the fields the result templates render, this keeps embeddings and descriptions off the wire
+HYDRATION_PROJECTION = {"title": 1, "s3_object_name": 1, "tags": 1, "page_no": 1, "pixiv_source_id": 1,
+                        "author_name": 1}
+HYDRATION_CACHE_TTL = getattr(config, "HYDRATION_CACHE_TTL", 30)
+HYDRATION_CACHE_SIZE = getattr(config, "HYDRATION_CACHE_SIZE", 10000)
+# Deepest result a vector search pages to, Qdrant still has to rank everything before the offset
+MAX_SEARCH_OFFSET = getattr(config, "MAX_SEARCH_OFFSET", 10000)
+# Hybrid search ranks this many filtered nearest neighbours (at least) before fusing in the tag matches
+HYBRID_CANDIDATES = getattr(config, "HYBRID_CANDIDATES", 200)
+MAX_HYBRID_POOL = max(HYBRID_CANDIDATES, MAX_SEARCH_OFFSET)
+# Reciprocal rank fusion constant, dampens the weight of the very first ranks
+RRF_K = 60
+
+hydration_cache = {}
+hydration_cache_lock = Lock()
+
+
+def encode_cursor(position):
+    """Packs a scroll/search position into an opaque, URL-safe continuation token."""
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(",", ":")).encode("utf-8")).decode("utf-8").rstrip("=")
+
+
+def is_offset(value):
+    return type(value) is int and 0 <= value <= MAX_SEARCH_OFFSET
+
+
+# Fields and their checks per cursor kind, a token from one listing is rejected by the others
+VECTOR_CURSOR = {"offset": is_offset}
+HYBRID_CURSOR = {"offset": is_offset, "pool": lambda value: type(value) is int and 0 < value <= MAX_HYBRID_POOL}
+TAG_CURSOR = {"offset_id": lambda value: type(value) in (str, int)}
+GALLERY_CURSOR = {"added_at": lambda value: type(value) is int, "_id": lambda value: type(value) is str}
+
+
+def decode_cursor(cursor, fields):
+    """Unpacks a continuation token, raises ValueError unless it has exactly the given fields with valid values."""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if not isinstance(position, dict) or position.keys() != fields.keys() or \
+            not all(check(position[field]) for field, check in fields.items()):
+        raise ValueError("Invalid cursor")
+    return position
+
+
+def page_offset(page, limit):
+    if not 1 <= page <= MAX_SEARCH_OFFSET // limit + 1:
+        raise ValueError("Invalid page")
+    return (page - 1) * limit
+
+
+def hydrate(image_ids, scores=None, use_cache=True):
+    """
+    Loads the artwork documents for a list of image IDs with a single $in query.
+
+    Results keep the order of image_ids (Qdrant's score order), IDs that no longer exist in Mongo are dropped.
+    If scores is given, each document gets its score attached.
+    """
+    now = time.monotonic()
+    documents = {}
+
+    if use_cache:
+        with hydration_cache_lock:
+            for image_id in image_ids:
+                cached = hydration_cache.get(image_id)
+                if cached is not None and cached[0] > now:
+                    documents[image_id] = cached[1]
+
+    missing = [image_id for image_id in image_ids if image_id not in documents]
+    if missing:
+        artwork_collection = get_sync_database().get_collection("artwork")
+        fetched = {artwork["_id"]: artwork for artwork in artwork_collection.find({"_id": {"$in": missing}}, HYDRATION_PROJECTION)}
+        documents.update(fetched)
+
+        if use_cache:
+            with hydration_cache_lock:
+                # Crude size bound, entries are only valid for a few seconds anyway
+                if len(hydration_cache) + len(fetched) > HYDRATION_CACHE_SIZE:
+                    hydration_cache.clear()
+                for image_id, artwork in fetched.items():
+                    hydration_cache[image_id] = (now + HYDRATION_CACHE_TTL, artwork)
+
+    hydrated_artwork = []
+    for idx, image_id in enumerate(image_ids):
+        artwork = documents.get(image_id)
+        if artwork is None:
+            continue
+        # Copy, so callers adding fields don't modify cached documents
+        artwork = dict(artwork)
+        if scores is not None:
+            artwork["score"] = scores[idx]
+        hydrated_artwork.append(artwork)
+    return hydrated_artwork
+
+
+def hydrate_points(points):
+    return hydrate([point.payload["image_id"] for point in points],
+                   scores=[getattr(point, "score", None) for point in points])
+
+
+def vector_search_points(vector, page=1, limit=25, cursor=None):
+    """Returns one page of Qdrant hits for a query vector and the continuation token for the next page."""
+    qdrant_client = get_qdrant_instance()
+
+    offset = decode_cursor(cursor, VECTOR_CURSOR)["offset"] if cursor else page_offset(page, limit)
+
+    # Qdrant skips the offset server-side, so only the requested page is transferred
+    results = qdrant_client.search(COLLECTION_NAME, query_vector=vector, limit=limit, offset=offset, with_payload=True,
+                                   search_params=search_params())
+
+    next_cursor = None
+    if len(results) == limit and offset + limit <= MAX_SEARCH_OFFSET:
+        next_cursor = encode_cursor({"offset": offset + limit})
+
+    return results, next_cursor
+
+
+def vector_search(vector, page=1, limit=25, cursor=None):
+    """
+    Runs a nearest-neighbour search for an already computed query vector and hydrates the hits.
+
+    Returns the page of results and a continuation token for the next one, or None if this was the last page.
+    """
+    results, next_cursor = vector_search_points(vector, page=page, limit=limit, cursor=cursor)
+    return {"results": hydrate_points(results), "next": next_cursor}
+
+
+def parse_query(query):
+    """
+    Splits a hybrid search query into free text, required tags (tag:foo), excluded tags (-foo) and an artist
+    (artist:"name").
+    """
+    try:
+        tokens = shlex.split(query)
+    except ValueError:
+        # Unbalanced quotes
+        tokens = query.split(" ")
+
+    parsed = {"text": [], "tags": [], "exclude": [], "author": None}
+    for token in tokens:
+        if token.startswith("artist:"):
+            parsed["author"] = token[len("artist:"):]
+        elif token.startswith("tag:"):
+            parsed["tags"].append(token[len("tag:"):])
+        elif token.startswith("-") and len(token) > 1:
+            parsed["exclude"].append(token[1:])
+        elif token:
+            parsed["text"].append(token)
+    return parsed
+
+
+def build_filter(tags=(), exclude=(), author=None, group_sets=False):
+    """Payload filter for tag, negative tag, artist and first-page-of-set conditions, all served by payload indexes."""
+    must = [FieldCondition(key="tags", match=MatchValue(value=tag)) for tag in tags]
+    if author:
+        must.append(FieldCondition(key="author_name", match=MatchValue(value=author)))
+    return Filter(
+        must=must,
+        must_not=[FieldCondition(key="tags", match=MatchValue(value=tag)) for tag in exclude],
+        should=[
+            FieldCondition(key="page_no", match=MatchValue(value=0)),
+            IsNullCondition(is_null=PayloadField(key="page_no"))
+        ] if group_sets else []
+    )
+
+
+def hybrid_search_points(vector, terms, tags=(), exclude=(), author=None, group_sets=False, page=1, limit=25,
+                         cursor=None):
+    """
+    Returns one page of nearest neighbours restricted by the tag/artist filter, fused with how many of the free
+    text terms each hit is tagged with.
+
+    The filter is applied inside Qdrant's HNSW search. The candidates are re-ranked with reciprocal rank fusion of
+    the vector rank and the tag match rank, hits without any matching tag only get the vector part. The pool size is
+    fixed by the first page and carried in the cursor, so every page slices the same ranking and paging stops at its
+    end.
+    """
+    qdrant_client = get_qdrant_instance()
+
+    if cursor:
+        position = decode_cursor(cursor, HYBRID_CURSOR)
+        offset, pool_size = position["offset"], position["pool"]
+    else:
+        offset = page_offset(page, limit)
+        pool_size = min(max(HYBRID_CANDIDATES, offset + limit), MAX_HYBRID_POOL)
+
+    candidates = qdrant_client.search(COLLECTION_NAME, query_vector=vector,
+                                      query_filter=build_filter(tags, exclude, author, group_sets), limit=pool_size,
+                                      with_payload=["image_id", "tags"], search_params=search_params())
+
+    terms = set(terms)
+    overlap = [len(terms.intersection(point.payload.get("tags") or [])) for point in candidates]
+    # Sorting is stable, so equal tag matches keep their vector order
+    tag_order = sorted((index for index in range(len(candidates)) if overlap[index]), key=lambda index: -overlap[index])
+    tag_rank = {index: rank for rank, index in enumerate(tag_order)}
+
+    def fused_score(index):
+        score = 1 / (RRF_K + index + 1)
+        if index in tag_rank:
+            score += 1 / (RRF_K + tag_rank[index] + 1)
+        return score
+
+    ranked = sorted(range(len(candidates)), key=fused_score, reverse=True)
+    results = [candidates[index] for index in ranked[offset:offset + limit]]
+
+    next_cursor = None
+    if len(candidates) > offset + limit and offset + limit <= MAX_SEARCH_OFFSET:
+        next_cursor = encode_cursor({"offset": offset + limit, "pool": pool_size})
+
+    return results, next_cursor
+
+
+def hybrid_search(vector, parsed, page=1, limit=25, group_sets=False, cursor=None):
+    """Runs hybrid_search_points for a parse_query result and hydrates the hits, see vector_search for the result."""
+    results, next_cursor = hybrid_search_points(vector, parsed["text"], tags=parsed["tags"],
+                                                exclude=parsed["exclude"], author=parsed["author"],
+                                                group_sets=group_sets, page=page, limit=limit, cursor=cursor)
+    return {"results": hydrate_points(results), "next": next_cursor}
+
+
+def hybrid_text(parsed):
+    """
+    Text sent to the text encoder for a hybrid query, the required tags stand in if there is no free text. Empty if
+    the query only has exclusions and an artist, there is nothing to rank by then.
+    """
+    return " ".join(parsed["text"] or parsed["tags"])
+
+
+def tag_search_points(tags, page=1, limit=25, group_sets=True, cursor=None):
+    """Returns one page of Qdrant points matching all tags and the continuation token for the next page."""
+    print("page: {0}, limit: {1}".format(page, limit))
+    qdrant_client = get_qdrant_instance()
+
+    offset_id = None
+
+    img_filter = build_filter(tags, group_sets=group_sets)
+
+    print("Filter: {0}".format(img_filter))
+
+    if cursor:
+        offset_id = decode_cursor(cursor, TAG_CURSOR)["offset_id"]
+    else:
+        page_offset(page, limit)
+        # Plain page numbers (e.g. "previous" links) still have to scroll their way to the page
+        while page > 1:
+            _, next_page = qdrant_client.scroll(COLLECTION_NAME, scroll_filter=img_filter, limit=limit, offset=offset_id,
+                                                with_payload=False)
+            print("Next page: {0} ({1} -> {2})".format(next_page, page, page-1))
+            if next_page is None:
+                page = 1
+            else:
+                offset_id = next_page
+            page -= 1
+
+    results, next_page = qdrant_client.scroll(COLLECTION_NAME, scroll_filter=img_filter, limit=limit, offset=offset_id,
+                                              with_payload=["image_id"])
+
+    return results, encode_cursor({"offset_id": next_page}) if next_page is not None else None
+
+
+def tag_search(tags, page=1, limit=25, group_sets=True, cursor=None):
+    results, next_cursor = tag_search_points(tags, page=page, limit=limit, group_sets=group_sets, cursor=cursor)
+    return {"results": hydrate([res.payload["image_id"] for res in results]), "next": next_cursor}
+
+
+def gallery_query(after=None, before=None):
+    """
+    Builds the gallery listing query, newest sets first.
+
+    With an after/before cursor this is a keyset query on (added_at, _id), so every page is a bounded index range
+    scan. Returns the filter and the sort, results of a "before" query have to be reversed by the caller.
+    """
+    # First page of every set, page_no is missing for non-pixiv artworks. Near-duplicates are left out.
+    query = {"page_no": {"$in": [0, None]}, "duplicate_of": None}
+    direction = -1
+
+    if after or before:
+        position = decode_cursor(after or before, GALLERY_CURSOR)
+        comparison = "$lt" if after else "$gt"
+        query["$or"] = [
+            {"added_at": {comparison: position["added_at"]}},
+            {"added_at": position["added_at"], "_id": {comparison: position["_id"]}}
+        ]
+        if before:
+            direction = 1
+
+    return query, [("added_at", direction), ("_id", direction)]
+
+
+def gallery_cursor(artwork):
+    return encode_cursor({"added_at": artwork["added_at"], "_id": artwork["_id"]})
+
+
+def similar_filter(image_id, pixiv_source_id):
+    """
+    Drops the searched-for ID, and results that have the same pixiv_source_id as the searched-for ID
+    (would probably all match, observed >0.95 filling all results). Pixiv ID of 0 = not set
+    """
+    must_not = [FieldCondition(key="image_id", match=MatchValue(value=image_id))]
+    if pixiv_source_id:
+        must_not.append(FieldCondition(key="pixiv_source_id", match=MatchValue(value=pixiv_source_id)))
+    return Filter(must_not=must_not)
+
+
+def similar_artworks(image_id, limit=25):
+    qdrant_client = get_qdrant_instance()
+
+    points = qdrant_client.retrieve(COLLECTION_NAME, ids=[point_id(image_id)], with_payload=True, with_vectors=True)
+    if not points:
+        # Not embedded yet
+        return
+    vector = points[0].vector
+    pixiv_source_id = points[0].payload.get("pixiv_source_id")
+
+    results = qdrant_client.search(COLLECTION_NAME, query_vector=vector,
+                                   query_filter=similar_filter(image_id, pixiv_source_id),
+                                   limit=limit, with_payload=True, search_params=search_params())
+
+    return hydrate_points(results)
@@ -105,6 +105,9 @@
                 timerProgressBar: true,
                 showConfirmButton: false
             });
+            if (data.progress_url) {
+                pollProgress(data.progress_url);
+            }
         }).catch(error => {
             Swal.fire({
                 title: "Error",
@@ -118,5 +121,27 @@
         });
     }
 
+    function pollProgress(progressURL) {
+        let button = document.getElementById("supaarchive-download-button");
+
+        let interval = setInterval(async () => {
+            let response = await fetch(`http://127.0.0.1:8000${progressURL}`);
+            if (!response.ok) {
+                clearInterval(interval);
+                return;
+            }
+            let progress = await response.json();
+            if (button) {
+                button.innerText = `Archiving ${progress.done}/${progress.total}` + (progress.failed ? ` (${progress.failed} failed)` : "");
+            }
+            if (progress.status === "done") {
+                clearInterval(interval);
+                if (button) {
+                    button.innerText = "Archived in SupaArchive";
+                }
+            }
+        }, 2000);
+    }
+
     setTimeout(deployButton, 1000);
 })();
\ No newline at end of file
@@ -0,0 +1,106 @@
+from collections import Counter
+
+from pymongo import UpdateOne
+
+# Archive statistics, kept up to date by the ingest and delete tasks so /stats never has to scan the archive.
+# "totals" holds the counters, tag_stats/artist_stats hold one document per tag/artist with its image count.
+# reconcile_stats in tasks.py recomputes everything periodically to correct drift.
+TOTALS_ID = "totals"
+
+
+def is_set_cover(artwork):
+    # Sets are counted by their first page, page_no is missing for non-pixiv artworks
+    return artwork.get("page_no") in (0, None)
+
+
+def increment_counts(collection, keys, amount):
+    """Adjusts per-key counts, returns how many keys appeared (count went from 0 to positive) or disappeared."""
+    counts = Counter(key for key in keys if key is not None)
+    if not counts:
+        return 0
+
+    result = collection.bulk_write([UpdateOne({"_id": key}, {"$inc": {"count": amount * count}}, upsert=True)
+                                    for key, count in counts.items()], ordered=False)
+    removed = collection.delete_many({"_id": {"$in": list(counts)}, "count": {"$lte": 0}}).deleted_count
+    return result.upserted_count - removed
+
+
+def record_tags_added(db, tags):
+    """Each entry counts as one more image with that tag, deduplicate per image before passing them in."""
+    new_tags = increment_counts(db.get_collection("tag_stats"), tags, 1)
+    if new_tags:
+        db.get_collection("stats").update_one({"_id": TOTALS_ID}, {"$inc": {"tags": new_tags}}, upsert=True)
+
+
+def record_artworks_added(db, artworks):
+    artworks = list(artworks)
+    if not artworks:
+        return
+
+    tags = [tag for artwork in artworks for tag in set(artwork.get("tags") or [])]
+    authors = [artwork.get("author_name") for artwork in artworks]
+
+    new_tags = increment_counts(db.get_collection("tag_stats"), tags, 1)
+    new_artists = increment_counts(db.get_collection("artist_stats"), authors, 1)
+
+    db.get_collection("stats").update_one({"_id": TOTALS_ID}, {"$inc": {
+        "images": len(artworks),
+        "sets": len([artwork for artwork in artworks if is_set_cover(artwork)]),
+        "tags": new_tags,
+        "artists": new_artists,
+    }}, upsert=True)
+
+
+def record_artworks_removed(db, artworks):
+    artworks = list(artworks)
+    if not artworks:
+        return
+
+    tags = [tag for artwork in artworks for tag in set(artwork.get("tags") or [])]
+    authors = [artwork.get("author_name") for artwork in artworks]
+
+    tag_change = increment_counts(db.get_collection("tag_stats"), tags, -1)
+    artist_change = increment_counts(db.get_collection("artist_stats"), authors, -1)
+
+    db.get_collection("stats").update_one({"_id": TOTALS_ID}, {"$inc": {
+        "images": -len(artworks),
+        "sets": -len([artwork for artwork in artworks if is_set_cover(artwork)]),
+        "tags": tag_change,
+        "artists": artist_change,
+    }}, upsert=True)
+
+
+def record_translations_added(db, count):
+    if count:
+        db.get_collection("stats").update_one({"_id": TOTALS_ID}, {"$inc": {"translations": count}}, upsert=True)
+
+
+def reconcile(db):
+    """Recomputes all statistics from the archive itself."""
+    artwork_collection = db.get_collection("artwork")
+
+    # Same rules as the incremental path: a tag counts once per image (record_artworks_added deduplicates with set())
+    # and artworks without an author don't count towards any artist (increment_counts skips None keys).
+    # $out swaps the result in atomically and keeps the existing indexes
+    artwork_collection.aggregate([
+        {"$project": {"tags": {"$setUnion": [{"$ifNull": ["$tags", []]}, []]}}},
+        {"$unwind": "$tags"},
+        {"$match": {"tags": {"$ne": None}}},
+        {"$group": {"_id": "$tags", "count": {"$sum": 1}}},
+        {"$out": "tag_stats"}
+    ])
+    artwork_collection.aggregate([
+        {"$match": {"author_name": {"$ne": None}}},
+        {"$group": {"_id": "$author_name", "count": {"$sum": 1}}},
+        {"$out": "artist_stats"}
+    ])
+
+    totals = {
+        "images": artwork_collection.count_documents({}),
+        "sets": artwork_collection.count_documents({"page_no": {"$in": [0, None]}}),
+        "tags": db.get_collection("tag_stats").count_documents({}),
+        "artists": db.get_collection("artist_stats").count_documents({}),
+        "translations": db.get_collection("translations").count_documents({}),
+    }
+    db.get_collection("stats").replace_one({"_id": TOTALS_ID}, totals, upsert=True)
+    return totals
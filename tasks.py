@@ -1,23 +1,32 @@
-import hashlib
-import hashlib
+import asyncio
 import os.path
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
 import celery
 import deepl
-import requests
+import httpx
+import redis.asyncio
 from celery import Celery
 from pygelbooru import Gelbooru
-from pymongo import MongoClient
+from pymongo import UpdateOne
 
 import config
 import model_worker
+import redis_conn
 import s3
+import search
+import stats
 from async_task import async_task
-from database import CONNECTION_STRING, Artwork
+from database import Artwork, get_sync_database, upsert_artwork, build_artwork_upsert
+from embedding_cache import text_embedding_cache
+from image_cache import RedisTier
+from imgproxy import imgproxy_url
+from ingest_io import download_to_file
+from maintenance import run_job, delete_artworks
 from s3 import upload_file
-from schema import PixivDownloadBatch
+from schema import PixivDownloadBatch, PixivIndexPayload
 from kombu import Exchange, Queue
 
 app = Celery('tasks', broker=config.CELERY_RABBITMQ_URL, backend=config.REDIS_URL, result_expires=60 * 60 * 24)
@@ -28,116 +37,257 @@ app.conf.task_queues = [
 app.conf.update(
     worker_prefetch_multiplier=1
 )
-
-gelbooru = Gelbooru()
+app.conf.beat_schedule = {
+    # Incremental stats can drift (crashed tasks, manual edits), recompute them every few hours
+    "reconcile-stats": {
+        "task": "tasks.reconcile_stats",
+        "schedule": getattr(config, "STATS_RECONCILE_INTERVAL", 60 * 60 * 6),
+    },
+}
+
+# Overridable so imports can run against a local stub of the API
+GELBOORU_API_URL = getattr(config, "GELBOORU_API_URL", "https://gelbooru.com/")
+GELBOORU_PAGE_SIZE = getattr(config, "GELBOORU_PAGE_SIZE", 100)
+GELBOORU_IMPORT_CONCURRENCY = getattr(config, "GELBOORU_IMPORT_CONCURRENCY", 8)
+# A walk whose next page hasn't run for this long is considered dead and may be started again
+GELBOORU_IMPORT_LOCK_SECONDS = getattr(config, "GELBOORU_IMPORT_LOCK_SECONDS", 60 * 30)
+
+gelbooru = Gelbooru(api=GELBOORU_API_URL)
+
+# Parallel imgproxy renders per warming task
+WARM_CONCURRENCY = getattr(config, "WARM_CONCURRENCY", 4)
+# Parallel page downloads per pixiv set
+PIXIV_SET_CONCURRENCY = getattr(config, "PIXIV_SET_CONCURRENCY", 4)
+
+PIXIV_HEADERS = {"Referer": "https://www.pixiv.net",
+                 "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:123.0) Gecko/20100101 Firefox/123.0"}
 
 @app.task
 def downloadPixivImage(pixivImage: PixivDownloadBatch):
     pixivImage = PixivDownloadBatch.parse_obj(pixivImage)
 
-    with MongoClient(CONNECTION_STRING) as connection:
-        db = connection.get_database("supaarchive")
-        artwork_collection = db.get_collection("artwork")
+    db = get_sync_database()
+    artwork_collection = db.get_collection("artwork")
 
-        # Check for existence of pixiv ID
-        if artwork_collection.find_one({"pixiv_source_id": pixivImage.illust_id, "page_no": pixivImage.page_no}):
-            print("Already exists")
-            return
+    # Check for existence of pixiv ID
+    if artwork_collection.find_one({"pixiv_source_id": pixivImage.illust_id, "page_no": pixivImage.page_no}):
+        print("Already exists")
+        return
+
+    # Create temp file
+    # Download image
+    with tempfile.TemporaryFile() as temp:
+        # Request image, hashing it while it is written to disk
+        sha256, _ = download_to_file(pixivImage.url, temp, headers=PIXIV_HEADERS)
+        print(sha256)
+
+        artwork = Artwork(s3_object_name="placeholder", _id=sha256, tags=pixivImage.tags,
+                          pixiv_source_id=pixivImage.illust_id, page_no=pixivImage.page_no, title=pixivImage.title,
+                          description=pixivImage.description, pixiv_author_id=pixivImage.author_id, author_name=pixivImage.author_name)
+
+        # Skipped by the bucket if the hash is already stored
+        artwork.s3_object_name = upload_file(temp, sha256, os.path.splitext(pixivImage.url)[1][1:])
+
+    store_artwork(db, artwork, {"pixiv_source_id": pixivImage.illust_id, "page_no": pixivImage.page_no})
 
-        # Create temp file
-        # Download image
-        with tempfile.TemporaryFile() as temp:
-            # Request image
-            res = requests.get(pixivImage.url, headers={"Referer": "https://www.pixiv.net",
-                                                        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64; rv:123.0) Gecko/20100101 Firefox/123.0"})
-
-            temp.write(res.content)
-
-            # Get sha256 of file
-            temp.seek(0)
-            sha256 = hashlib.sha256(temp.read()).hexdigest()
-            print(sha256)
-
-            temp.seek(0)
-
-            artwork = Artwork(s3_object_name="placeholder", _id=sha256, tags=pixivImage.tags,
-                              pixiv_source_id=pixivImage.illust_id, page_no=pixivImage.page_no, title=pixivImage.title,
-                              description=pixivImage.description, pixiv_author_id=pixivImage.author_id, author_name=pixivImage.author_name)
-
-            # Check for existence of sha256
-            if artwork_collection.find_one({"_id": sha256}):
-                print("Already exists, merging tags")
-
-                artwork_collection.update_one({"_id": sha256}, {"$set": {"tags": list(set(artwork.tags + artwork_collection.find_one({"_id": sha256})["tags"]))}})
-                # use $addFields to add metadata to the document
-                artwork_collection.update_one({"_id": sha256}, [
-                    {
-                        "$set": {
-                            "pixiv_source_id": {
-                                "$cond": {
-                                    "if": {"$eq": [pixivImage.illust_id, {"$ifNull": ["$pixiv_source_id", 0]}]},
-                                    "then": "$pixiv_source_id",
-                                    "else": pixivImage.illust_id
-                                }
-                            },
-                            "page_no": {
-                                "$cond": {
-                                    "if": {"$eq": [pixivImage.page_no, {"$ifNull": ["$page_no", 0]}]},
-                                    "then": "$page_no",
-                                    "else": pixivImage.page_no
-                                }
-                            }
-                        }
-                    }
-                ])
-            else:
-                artwork.s3_object_name = upload_file(temp, sha256, os.path.splitext(pixivImage.url)[1][1:])
-                artwork_collection.insert_one(artwork.model_dump(by_alias=True))
-                model_worker.generate_embeddings.apply_async([sha256], countdown=10)
+
+def pixiv_set_progress_key(illust_id):
+    return f"pixivset:{illust_id}"
+
+
+@app.task
+def downloadPixivSet(pixivSet: PixivIndexPayload):
+    """Archives every page of a pixiv submission in one task, progress is kept under pixiv_set_progress_key."""
+    pixivSet = PixivIndexPayload.parse_obj(pixivSet)
+
+    db = get_sync_database()
+    artwork_collection = db.get_collection("artwork")
+    redis = redis_conn.redis_client
+    progress_key = pixiv_set_progress_key(pixivSet.illustration_id)
+
+    # Pages of this set that are already archived
+    known_pages = {artwork.get("page_no") for artwork in
+                   artwork_collection.find({"pixiv_source_id": pixivSet.illustration_id}, {"page_no": 1})}
+    pages = [(page_no, url) for page_no, url in enumerate(pixivSet.pages) if page_no not in known_pages]
+
+    redis.hset(progress_key, mapping={"status": "downloading", "total": len(pixivSet.pages),
+                                      "done": len(pixivSet.pages) - len(pages), "failed": 0})
+    redis.expire(progress_key, 60 * 60 * 24)
+
+    def download_page(page):
+        page_no, url = page
+        try:
+            with tempfile.TemporaryFile() as temp:
+                sha256, _ = download_to_file(url, temp, headers=PIXIV_HEADERS)
+
+                artwork = Artwork(s3_object_name="placeholder", _id=sha256, tags=pixivSet.tags,
+                                  pixiv_source_id=pixivSet.illustration_id, page_no=page_no, title=pixivSet.title,
+                                  description=pixivSet.description, pixiv_author_id=pixivSet.author_id,
+                                  author_name=pixivSet.author_name)
+                artwork.s3_object_name = upload_file(temp, sha256, os.path.splitext(url)[1][1:])
+        except Exception as e:
+            print(f"Failed to archive page {page_no} of {pixivSet.illustration_id}: {e}")
+            redis.hincrby(progress_key, "failed", 1)
+            return None
+
+        redis.hincrby(progress_key, "done", 1)
+        return artwork
+
+    with ThreadPoolExecutor(max_workers=PIXIV_SET_CONCURRENCY) as pool:
+        artworks = [artwork for artwork in pool.map(download_page, pages) if artwork is not None]
+
+    inserted_ids = []
+    if artworks:
+        redis.hset(progress_key, "status", "storing")
+        inserted_ids = store_artworks(db, [(artwork, {"pixiv_source_id": artwork.pixiv_source_id, "page_no": artwork.page_no})
+                                           for artwork in artworks])
+
+    redis.hset(progress_key, "status", "done")
+    print(f"Archived pixiv set {pixivSet.illustration_id}: {len(inserted_ids)} new of {len(pages)} downloaded pages")
+    return {"downloaded": len(artworks), "inserted": len(inserted_ids), "failed": len(pages) - len(artworks)}
 
 
 @app.task
 def downloadGelbooru(gelbooruImage):
-    with MongoClient(CONNECTION_STRING) as connection:
-        db = connection.get_database("supaarchive")
-        artwork_collection = db.get_collection("artwork")
+    archive_gelbooru_post(gelbooruImage)
+
+
+def archive_gelbooru_post(gelbooruImage, check_existing=True):
+    """Downloads and stores a single gelbooru post, returns whether anything was downloaded."""
+    db = get_sync_database()
+    artwork_collection = db.get_collection("artwork")
 
-        # Check for existence of gelbooru file ID
-        if artwork_collection.find_one({"gelbooru_id": gelbooruImage["id"]}):
-            print("Already exists")
-            return
+    # Check for existence of gelbooru file ID
+    if check_existing and artwork_collection.find_one({"gelbooru_id": gelbooruImage["id"]}):
+        print("Already exists")
+        return False
 
-        # Check if webm or mp4
-        if gelbooruImage["url"].endswith(".webm") or gelbooruImage["url"].endswith(".mp4"):
-            print("Ignoring webm/mp4")
-            return
+    # Check if webm or mp4
+    if gelbooruImage["url"].endswith(".webm") or gelbooruImage["url"].endswith(".mp4"):
+        print("Ignoring webm/mp4")
+        return False
+
+    # Create temp file
+    # Download image
+    with tempfile.TemporaryFile() as temp:
+        sha256, _ = download_to_file(gelbooruImage["url"], temp)
+        print(sha256)
+
+        artwork = Artwork(s3_object_name="placeholder", _id=sha256, tags=gelbooruImage["tags"], gelbooru_id=gelbooruImage["id"])
+
+        # Skipped by the bucket if the hash is already stored
+        artwork.s3_object_name = upload_file(temp, sha256, os.path.splitext(gelbooruImage["url"])[1][1:])
+
+    store_artwork(db, artwork, {"gelbooru_id": gelbooruImage["id"]})
+    return True
+
+
+def store_artwork(db, artwork, source_fields):
+    """Inserts or merges a downloaded artwork and kicks off everything that follows a new image."""
+    previous_tags = upsert_artwork(db.get_collection("artwork"), artwork, source_fields)
+
+    if previous_tags is not None:
+        print("Already exists, merged tags")
+        stats.record_tags_added(db, list(set(artwork.tags) - set(previous_tags)))
+        model_worker.sync_merged_payloads.delay([artwork.id])
+        return
+
+    stats.record_artworks_added(db, [artwork.model_dump(by_alias=True)])
+    model_worker.enqueue_embeddings([artwork.id], countdown=10)
+    warm_images.apply_async([[artwork.id]], priority=1)
+
+
+def store_artworks(db, entries):
+    """
+    Bulk version of store_artwork for (artwork, source_fields) pairs.
+
+    All documents go in with one bulk write and the new ones are handed to embedding and warming as one batch.
+    Returns the IDs of the newly inserted artworks.
+    """
+    artwork_collection = db.get_collection("artwork")
 
-        # Create temp file
-        # Download image
-        with tempfile.TemporaryFile() as temp:
-            res = requests.get(gelbooruImage["url"])
-            temp.write(res.content)
-            temp.seek(0)
+    # Only needed to keep the tag statistics right for merged duplicates
+    previous_tags = {artwork["_id"]: artwork["tags"] for artwork in
+                     artwork_collection.find({"_id": {"$in": [artwork.id for artwork, _ in entries]}}, {"tags": 1})}
 
-            # Get sha256 of file
-            sha256 = hashlib.sha256(temp.read()).hexdigest()
-            print(sha256)
+    result = artwork_collection.bulk_write([UpdateOne(*build_artwork_upsert(artwork, source_fields), upsert=True)
+                                            for artwork, source_fields in entries], ordered=False)
+    inserted_ids = list(dict.fromkeys(result.upserted_ids.values()))
 
-            temp.seek(0)
+    inserted = set(inserted_ids)
+    stats.record_artworks_added(db, [artwork.model_dump(by_alias=True) for artwork, _ in entries if artwork.id in inserted])
+    stats.record_tags_added(db, [tag for artwork, _ in entries if artwork.id in previous_tags
+                                 for tag in set(artwork.tags) - set(previous_tags[artwork.id])])
 
-            artwork = Artwork(s3_object_name="placeholder", _id=sha256, tags=gelbooruImage["tags"], gelbooru_id=gelbooruImage["id"])
+    if inserted_ids:
+        model_worker.enqueue_embeddings(inserted_ids, countdown=10)
+        warm_images.apply_async([inserted_ids], priority=1)
+    merged_ids = list(dict.fromkeys(artwork.id for artwork, _ in entries if artwork.id not in inserted))
+    if merged_ids:
+        model_worker.sync_merged_payloads.delay(merged_ids)
+    return inserted_ids
 
-            # Check for existence of sha256
-            if artwork_collection.find_one({"_id": sha256}):
-                print("Already exists, merging tags")
 
-                artwork_collection.update_one({"_id": sha256}, {"$set": {"tags": list(set(artwork.tags + artwork_collection.find_one({"_id": sha256})["tags"]))}})
-                # use $addFields to add metadata to the document
-                artwork_collection.update_one({"_id": sha256}, {"$addFields": {"gelbooru_id": gelbooruImage["id"]}})
-            else:
-                artwork.s3_object_name = upload_file(temp, sha256, os.path.splitext(gelbooruImage["url"])[1][1:])
-                artwork_collection.insert_one(artwork.model_dump(by_alias=True))
-                model_worker.generate_embeddings.apply_async([sha256], countdown=10)
+@async_task(app)
+async def warm_images(image_ids, variant="thumbnail"):
+    """Renders image variants through imgproxy ahead of their first view and stores them in the shared cache."""
+    db = get_sync_database()
+    artwork_collection = db.get_collection("artwork")
+    artworks = list(artwork_collection.find({"_id": {"$in": image_ids}}, {"s3_object_name": 1}))
+
+    # Own clients, the shared async ones belong to the web app's event loop
+    async with redis.asyncio.Redis.from_url(config.REDIS_URL) as client, httpx.AsyncClient(timeout=30) as http_client:
+        cache = RedisTier(client=client)
+        semaphore = asyncio.Semaphore(WARM_CONCURRENCY)
+
+        async def warm(artwork):
+            if await cache.exists(variant, artwork["_id"]):
+                return False
+            async with semaphore:
+                response = await http_client.get(imgproxy_url(variant, f"{s3.base_url}{artwork['s3_object_name']}"))
+            if response.status_code != 200:
+                print(f"Warming {artwork['_id']} ({variant}) failed with {response.status_code}")
+                return False
+            await cache.set(variant, artwork["_id"], response.content, warmed=True)
+            return True
+
+        warmed = sum(await asyncio.gather(*[warm(artwork) for artwork in artworks]))
+
+    print(f"Warmed {warmed} of {len(image_ids)} {variant} images")
+    return {"warmed": warmed, "skipped": len(image_ids) - warmed}
+
+
+@app.task
+def warm_next_page(kind, cursor, query=None, group_sets=False, limit=25):
+    """Warms the thumbnails of the page behind a gallery or search continuation token."""
+    if kind == "gallery":
+        gallery_query, sort = search.gallery_query(after=cursor)
+        artwork_collection = get_sync_database().get_collection("artwork")
+        image_ids = [artwork["_id"] for artwork in artwork_collection.find(gallery_query, {"_id": 1}).sort(sort).limit(limit)]
+    elif kind == "tags":
+        points, _ = search.tag_search_points(query.split(" "), limit=limit, group_sets=group_sets, cursor=cursor)
+        image_ids = [point.payload["image_id"] for point in points]
+    elif kind == "neural":
+        # Only worth it if the query vector is still cached, warming must never cost a model run
+        vector = text_embedding_cache.get(query)
+        if vector is None:
+            return
+        points, _ = search.vector_search_points(vector, limit=limit, cursor=cursor)
+        image_ids = [point.payload["image_id"] for point in points]
+    elif kind == "hybrid":
+        parsed = search.parse_query(query)
+        vector = text_embedding_cache.get(search.hybrid_text(parsed))
+        if vector is None:
+            return
+        points, _ = search.hybrid_search_points(vector, parsed["text"], tags=parsed["tags"], exclude=parsed["exclude"],
+                                                author=parsed["author"], group_sets=group_sets, limit=limit,
+                                                cursor=cursor)
+        image_ids = [point.payload["image_id"] for point in points]
+    else:
+        raise ValueError(f"Unknown page kind: {kind}")
+
+    if image_ids:
+        return warm_images(image_ids)
 
 
 @async_task(app, bind=True)
@@ -158,76 +308,251 @@ async def fetch_gelbooru(self: celery.Task, tag, limit):
         })
 
 
+def gelbooru_checkpoint_id(tags):
+    return "gelbooru:" + " ".join(sorted(tags))
+
+
+def gelbooru_import_lock_key(tags):
+    return "import:" + gelbooru_checkpoint_id(tags)
+
+
+@async_task(app, bind=True, acks_late=True)
+async def import_gelbooru(self: celery.Task, tag, max_posts=None, continuation=False):
+    """
+    Imports every post for a tag query, resuming from the last checkpoint.
+
+    Instead of page numbers (which the API caps) the import walks post IDs downwards with an id:< filter. Every page
+    is its own short task that checkpoints the lowest finished ID and queues the next page, so no single message stays
+    unacknowledged past the broker's consumer timeout. A restarted import continues where it stopped and a finished
+    one only picks up posts newer than its first run. Posts that fail to archive are kept in the checkpoint and
+    retried at the start of the next run, the ID walk doesn't wait for them.
+    """
+    tags = tag.split(" ") if isinstance(tag, str) else tag
+    checkpoints = get_sync_database().get_collection("import_checkpoints")
+    artwork_collection = get_sync_database().get_collection("artwork")
+    checkpoint_id = gelbooru_checkpoint_id(tags)
+    lock_key = gelbooru_import_lock_key(tags)
+
+    # One walk per tag query, a second one would overwrite the same checkpoint. The lock outlives a crashed walk
+    # only by its TTL, which every page renews.
+    if continuation:
+        redis_conn.redis_client.expire(lock_key, GELBOORU_IMPORT_LOCK_SECONDS)
+    elif not redis_conn.redis_client.set(lock_key, self.request.id or 1, nx=True, ex=GELBOORU_IMPORT_LOCK_SECONDS):
+        print(f"Gelbooru import {tags} is already running")
+        return None
+
+    checkpoint = checkpoints.find_one({"_id": checkpoint_id}) or {}
+    if checkpoint.get("done") and not continuation:
+        # Start over from the top, but stop once we reach posts the previous run already covered
+        stop_below = checkpoint.get("newest_id")
+        checkpoint = {"newest_id": stop_below, "before_id": None, "imported": checkpoint.get("imported", 0),
+                      "skipped": checkpoint.get("skipped", 0), "retry": checkpoint.get("retry", [])}
+    else:
+        stop_below = checkpoint.get("stop_below")
+    checkpoint["stop_below"] = stop_below
+    checkpoint["done"] = False
+
+    semaphore = asyncio.Semaphore(GELBOORU_IMPORT_CONCURRENCY)
+
+    async def archive(post):
+        async with semaphore:
+            try:
+                return await asyncio.to_thread(archive_gelbooru_post, post, check_existing=False)
+            except Exception as e:
+                print(f"Failed to import gelbooru post {post['id']}: {e}")
+                return None
+
+    async def archive_all(posts):
+        results = await asyncio.gather(*[archive(post) for post in posts])
+        checkpoint["imported"] = checkpoint.get("imported", 0) + len([result for result in results if result])
+        checkpoint["skipped"] = checkpoint.get("skipped", 0) + len([result for result in results if result is False])
+        checkpoint["retry"] = checkpoint.get("retry", []) + [post for post, result in zip(posts, results) if result is None]
+
+    retry = checkpoint.get("retry", [])
+    if retry and not continuation:
+        checkpoint["retry"] = []
+        known_ids = set(artwork_collection.distinct("gelbooru_id", {"gelbooru_id": {"$in": [post["id"] for post in retry]}}))
+        await archive_all([post for post in retry if post["id"] not in known_ids])
+
+    posts = []
+    if max_posts is None or max_posts > 0:
+        query_tags = tags + ([f"id:<{checkpoint['before_id']}"] if checkpoint.get("before_id") else [])
+        posts = await gelbooru.search_posts(tags=query_tags, limit=GELBOORU_PAGE_SIZE)
+        if not isinstance(posts, list):
+            posts = [posts] if posts else []
+        if stop_below is not None:
+            posts = [post for post in posts if post.id > stop_below]
+        checkpoint["done"] = not posts
+
+    if posts:
+        # One query for the whole page instead of one per post
+        known_ids = set(artwork_collection.distinct("gelbooru_id", {"gelbooru_id": {"$in": [post.id for post in posts]}}))
+        checkpoint["skipped"] = checkpoint.get("skipped", 0) + len(known_ids)
+        await archive_all([{
+            "tags": post.tags,
+            "url": post.file_url,
+            "source": "gelbooru",
+            "id": post.id
+        } for post in posts if post.id not in known_ids])
+        checkpoint["before_id"] = min(post.id for post in posts)
+        checkpoint["newest_id"] = max(checkpoint.get("newest_id") or 0, max(post.id for post in posts))
+        print(f"Gelbooru import {tags}: down to ID {checkpoint['before_id']}")
+
+    checkpoints.replace_one({"_id": checkpoint_id}, checkpoint, upsert=True)
+
+    remaining = None if max_posts is None else max_posts - len(posts)
+    if posts and (remaining is None or remaining > 0):
+        import_gelbooru.delay(tags, max_posts=remaining, continuation=True)
+    else:
+        redis_conn.redis_client.delete(lock_key)
+    return {key: checkpoint.get(key) for key in ("imported", "skipped", "done")} | {"failed": len(checkpoint.get("retry", []))}
+
+
+# Objects below this size are failed downloads (error pages, empty files)
+MIN_OBJECT_SIZE = 2000
+INTEGRITY_HEAD_CONCURRENCY = getattr(config, "INTEGRITY_HEAD_CONCURRENCY", 16)
+# Projection with everything the deletion bookkeeping needs
+ARTWORK_STATS_PROJECTION = {"s3_object_name": 1, "tags": 1, "author_name": 1, "page_no": 1}
+
+
+async def verify_objects(artworks):
+    """HEADs the public URLs of the given artworks with a bounded pool, returns the ones that really are broken."""
+    semaphore = asyncio.Semaphore(INTEGRITY_HEAD_CONCURRENCY)
+
+    async with httpx.AsyncClient(timeout=30) as http_client:
+        async def is_broken(artwork):
+            async with semaphore:
+                try:
+                    res = await http_client.head(f"{s3.base_url}{artwork['s3_object_name']}")
+                except httpx.HTTPError:
+                    # Can't tell, better keep it
+                    return False
+            return res.status_code == 404 or (res.status_code == 200 and int(res.headers.get("Content-Length", MIN_OBJECT_SIZE)) < MIN_OBJECT_SIZE)
+
+        results = await asyncio.gather(*[is_broken(artwork) for artwork in artworks])
+
+    return [artwork for artwork, broken in zip(artworks, results) if broken]
+
+
+@async_task(app)
+async def scan_integrity(dry_run=True, batch_size=1000):
+    """
+    Finds artworks whose file is missing from the bucket or too small to be an image.
+
+    The bucket listing and a projected cursor over the archive, both in key order, are merge joined page by page,
+    so neither side is ever held in memory. Only the candidates from that comparison are HEADed, to rule out listing
+    glitches before anything gets deleted. With dry_run nothing is deleted and the report lists what would be.
+    """
+    db = get_sync_database()
+    artwork_collection = db.get_collection("artwork")
+
+    pages = s3.list_object_pages()
+    listing = iter(())
+
+    async def next_object():
+        nonlocal listing
+        while True:
+            obj = next(listing, None)
+            if obj is not None:
+                return obj
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                return None
+            report["listed"] += len(page)
+            listing = iter(page)
+
+    report = {"scanned": 0, "listed": 0, "missing": 0, "too_small": 0, "deleted": 0, "dry_run": dry_run,
+              "examples": []}
+    candidates = []
+    obj = await next_object()
+
+    async def flush(candidates):
+        broken = await verify_objects(candidates)
+        report["examples"].extend(artwork["_id"] for artwork in broken[:100 - len(report["examples"])])
+        if not dry_run:
+            report["deleted"] += delete_artworks(db, broken)
+        return broken
+
+    # Served by the s3_object_name index, strings sort by their UTF-8 bytes like the bucket listing
+    for artwork in artwork_collection.find({}, ARTWORK_STATS_PROJECTION).sort("s3_object_name", 1).batch_size(batch_size):
+        report["scanned"] += 1
+        # Objects without an artwork are skipped, the listing never goes back
+        while obj is not None and obj[0] < artwork["s3_object_name"]:
+            obj = await next_object()
+        size = obj[1] if obj is not None and obj[0] == artwork["s3_object_name"] else None
+        if size is None:
+            report["missing"] += 1
+        elif size < MIN_OBJECT_SIZE:
+            report["too_small"] += 1
+        else:
+            continue
+
+        candidates.append(artwork)
+        if len(candidates) >= batch_size:
+            await flush(candidates)
+            candidates = []
+
+    if candidates:
+        await flush(candidates)
+
+    print(f"Integrity scan: {report}")
+    return report
+
+
 @app.task
 def delete_broken_art():
-    with MongoClient(CONNECTION_STRING) as connection:
-        db = connection.get_database("supaarchive")
-        artwork_collection = db.get_collection("artwork")
-
-        artworks = artwork_collection.find()
-
-        for artwork in artworks:
-            # Make HEAD request to see if the file exists
-            res = requests.head(f"{s3.base_url}{artwork['s3_object_name']}")
-            if res.status_code != 200:
-                print(f"Broken link: {artwork['_id']}")
-                print(f"Deleting {artwork['_id']}")
-                artwork_collection.delete_one({"_id": artwork["_id"]})
-                continue
-            elif int(res.headers["Content-Length"]) < 2000:
-                print(f"Too small: {artwork['_id']}")
-                print(f"Deleting {artwork['_id']}")
-                artwork_collection.delete_one({"_id": artwork["_id"]})
-                continue
+    return scan_integrity(dry_run=False)
 
 
 @app.task
 def delete_videos():
-    with MongoClient(CONNECTION_STRING) as connection:
-        db = connection.get_database("supaarchive")
-        artwork_collection = db.get_collection("artwork")
-
-        artworks = artwork_collection.find()
-
-        for artwork in artworks:
-            if artwork["s3_object_name"].endswith(".webm") or artwork["s3_object_name"].endswith(".mp4"):
-                print(f"Deleting video: {artwork['_id']}")
-                artwork_collection.delete_one({"_id": artwork["_id"]})
-                continue
+    # Matched inside Mongo, only the video documents ever leave the database
+    return run_job(get_sync_database(), "delete_videos",
+                   {"s3_object_name": {"$regex": r"\.(webm|mp4)$"}}, ARTWORK_STATS_PROJECTION,
+                   delete_artworks)
 
 
 @app.task
 def translate_image_metadata(image_id):
-    with MongoClient(CONNECTION_STRING) as connection:
-        db = connection.get_database("supaarchive")
-        artwork_collection = db.get_collection("artwork")
+    db = get_sync_database()
+    artwork_collection = db.get_collection("artwork")
 
-        artwork = artwork_collection.find({"_id": image_id}).limit(1)
+    artwork = artwork_collection.find({"_id": image_id}).limit(1)
 
-        if not artwork:
-            raise ValueError("Artwork not found")
+    if not artwork:
+        raise ValueError("Artwork not found")
 
-        artwork = artwork[0]
+    artwork = artwork[0]
 
-        translator = deepl.Translator(config.DEEPL_API_KEY)
+    translator = deepl.Translator(config.DEEPL_API_KEY)
 
-        translated_title = translator.translate_text(artwork["title"], target_lang="EN-US").text
-        translated_description = translator.translate_text(artwork["description"], target_lang="EN-US").text
+    translated_title = translator.translate_text(artwork["title"], target_lang="EN-US").text
+    translated_description = translator.translate_text(artwork["description"], target_lang="EN-US").text
 
-        translation_collection = db.get_collection("translations")
+    translation_collection = db.get_collection("translations")
 
-        # In case of a pixiv ID, the entire set will have the same translation.
-        if artwork["pixiv_source_id"]:
-            translation_collection.insert_many([
-                {
-                    "_id": image["_id"],
-                    "title": translated_title,
-                    "description": translated_description
-                } for image in artwork_collection.find({"pixiv_source_id": artwork["pixiv_source_id"]})
-            ])
-        else:
-            translation_collection.insert_one({
-                "_id": image_id,
+    # In case of a pixiv ID, the entire set will have the same translation.
+    if artwork["pixiv_source_id"]:
+        result = translation_collection.insert_many([
+            {
+                "_id": image["_id"],
                 "title": translated_title,
                 "description": translated_description
-            })
+            } for image in artwork_collection.find({"pixiv_source_id": artwork["pixiv_source_id"]})
+        ])
+        stats.record_translations_added(db, len(result.inserted_ids))
+    else:
+        translation_collection.insert_one({
+            "_id": image_id,
+            "title": translated_title,
+            "description": translated_description
+        })
+        stats.record_translations_added(db, 1)
+
+
+@app.task
+def reconcile_stats():
+    db = get_sync_database()
+    totals = stats.reconcile(db)
+    print(f"Reconciled stats: {totals}")
+    return totals
@@ -0,0 +1,259 @@
+import hashlib
+import time
+import uuid
+
+from qdrant_client import QdrantClient
+from qdrant_client.models import VectorParams, Distance, PointStruct, HnswConfigDiff, ScalarQuantization, \
+    ScalarQuantizationConfig, ScalarType, BinaryQuantization, BinaryQuantizationConfig, SearchParams, \
+    QuantizationSearchParams, CreateAlias, CreateAliasOperation, DeleteAlias, DeleteAliasOperation, PointIdsList
+
+import config
+import redis_conn
+
+# Name everything reads and writes through. After the first rebuild it is an alias pointing at the live collection.
+COLLECTION_NAME = "vit_embeddings"
+# Qdrant holds the only copy of the vectors, artworks only store the version their embedding was generated with.
+# Bump this when the model changes.
+EMBEDDING_VERSION = getattr(config, "EMBEDDING_VERSION", 1)
+
+# Detected from the loaded model when unset, only needs to be configured if the web app may create the collection
+QDRANT_VECTOR_SIZE = getattr(config, "QDRANT_VECTOR_SIZE", None)
+# None, "scalar" (int8, ~4x less memory) or "binary" (~32x less memory, needs rescoring to keep recall)
+QDRANT_QUANTIZATION = getattr(config, "QDRANT_QUANTIZATION", None)
+QDRANT_QUANTIZATION_RESCORE = getattr(config, "QDRANT_QUANTIZATION_RESCORE", True)
+QDRANT_QUANTIZATION_OVERSAMPLING = getattr(config, "QDRANT_QUANTIZATION_OVERSAMPLING", 2.0)
+QDRANT_HNSW_M = getattr(config, "QDRANT_HNSW_M", 16)
+QDRANT_HNSW_EF_CONSTRUCT = getattr(config, "QDRANT_HNSW_EF_CONSTRUCT", 100)
+# Search-time beam width, None uses Qdrant's default
+QDRANT_SEARCH_EF = getattr(config, "QDRANT_SEARCH_EF", None)
+# Keep full vectors, the HNSW graph and payloads on disk, the quantized vectors stay in RAM
+QDRANT_ON_DISK = getattr(config, "QDRANT_ON_DISK", False)
+
+PAYLOAD_INDEXES = [
+    ("tags", "keyword"),
+    ("page_no", "integer"),
+    ("added_at", "integer"),
+    ("pixiv_source_id", "integer"),
+    ("image_id", "keyword"),
+    ("author_name", "keyword"),
+]
+
+# Set while rebuild_collection runs: embedding batches wait, every other writer records the image IDs it touches
+REBUILD_KEY = "qdrant:rebuilding"
+REBUILD_CHANGES_KEY = "qdrant:rebuild:changed"
+# Seconds to let writes that were in flight during the alias switch land before the last re-sync
+REBUILD_SETTLE_SECONDS = 5
+
+qdrant_client = None
+
+
+def get_qdrant_instance():
+    global qdrant_client
+    if qdrant_client is None:
+        qdrant_client = QdrantClient(config.QDRANT_HOST)
+        if QDRANT_VECTOR_SIZE is not None:
+            ensure_collection(qdrant_client, QDRANT_VECTOR_SIZE)
+        return qdrant_client
+    return qdrant_client
+
+
+def quantization_config():
+    if QDRANT_QUANTIZATION == "scalar":
+        return ScalarQuantization(scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99,
+                                                                  always_ram=True))
+    if QDRANT_QUANTIZATION == "binary":
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=True))
+    if QDRANT_QUANTIZATION is not None:
+        raise ValueError(f"Unknown quantization: {QDRANT_QUANTIZATION}")
+    return None
+
+
+def search_params():
+    """Search parameters for every vector query, so the configured ef and rescoring apply everywhere."""
+    quantization = None
+    if QDRANT_QUANTIZATION is not None:
+        quantization = QuantizationSearchParams(rescore=QDRANT_QUANTIZATION_RESCORE,
+                                                oversampling=QDRANT_QUANTIZATION_OVERSAMPLING)
+    return SearchParams(hnsw_ef=QDRANT_SEARCH_EF, quantization=quantization)
+
+
+def resolve_collection(client):
+    """Returns the name of the collection behind COLLECTION_NAME, or None if there is none yet."""
+    for alias in client.get_aliases().aliases:
+        if alias.alias_name == COLLECTION_NAME:
+            return alias.collection_name
+    if client.collection_exists(COLLECTION_NAME):
+        return COLLECTION_NAME
+    return None
+
+
+def create_collection(client, name, vector_size):
+    client.create_collection(
+        name,
+        VectorParams(size=vector_size, distance=Distance.COSINE, on_disk=QDRANT_ON_DISK),
+        hnsw_config=HnswConfigDiff(m=QDRANT_HNSW_M, ef_construct=QDRANT_HNSW_EF_CONSTRUCT, on_disk=QDRANT_ON_DISK),
+        quantization_config=quantization_config(),
+        on_disk_payload=QDRANT_ON_DISK,
+    )
+    for field, schema in PAYLOAD_INDEXES:
+        client.create_payload_index(name, field, schema)
+
+
+def ensure_collection(client, vector_size):
+    """
+    Creates the collection with the configured settings if it doesn't exist yet, adds payload indexes introduced
+    since it was created and warns on a size mismatch.
+    """
+    name = resolve_collection(client)
+    if name is None:
+        create_collection(client, COLLECTION_NAME, vector_size)
+        return
+
+    collection = client.get_collection(name)
+    for field, schema in PAYLOAD_INDEXES:
+        if field not in collection.payload_schema:
+            print(f"Adding payload index {field} to {name}")
+            client.create_payload_index(name, field, schema)
+
+    existing_size = collection.config.params.vectors.size
+    if existing_size != vector_size:
+        print(f"Collection {name} stores vectors of size {existing_size}, the model outputs {vector_size}. "
+              "Re-embed into a rebuilt collection (rebuild_collection(vector_size=...)).")
+
+
+def rebuild_in_progress():
+    return redis_conn.redis_client.exists(REBUILD_KEY) > 0
+
+
+def record_changes(image_ids):
+    """Called by everything that writes points, so a running rebuild can re-sync them. Call before writing."""
+    if image_ids and rebuild_in_progress():
+        redis_conn.redis_client.sadd(REBUILD_CHANGES_KEY, *image_ids)
+
+
+def resync_points(client, source, target, image_ids):
+    """
+    Brings the given points in target in line with Mongo: removed, duplicate or unembedded artworks are deleted,
+    the rest get their payload rebuilt from Mongo and their vector from target, or source if target lacks it.
+    Artworks whose vector is gone from both are queued for re-embedding by clearing their marker.
+    """
+    from database import get_sync_database
+    artwork_collection = get_sync_database().get_collection("artwork")
+    artworks = {artwork["_id"]: artwork for artwork in artwork_collection.find(
+        {"_id": {"$in": image_ids}, "embedding_version": {"$ne": None}, "duplicate_of": None},
+        {"tags": 1, "title": 1, "page_no": 1, "pixiv_source_id": 1, "author_name": 1})}
+
+    removed = [point_id(image_id) for image_id in image_ids if image_id not in artworks]
+    if removed:
+        client.delete(target, points_selector=PointIdsList(points=removed))
+
+    # Keyed by image ID, Qdrant hands point IDs back in its own UUID formatting
+    vectors = {}
+    if artworks:
+        vectors = {point.payload["image_id"]: point.vector for point in client.retrieve(
+            target, ids=[point_id(image_id) for image_id in artworks], with_payload=["image_id"], with_vectors=True)}
+    missing = [image_id for image_id in artworks if image_id not in vectors]
+    if source is not None and missing:
+        vectors.update({point.payload["image_id"]: point.vector for point in client.retrieve(
+            source, ids=[point_id(image_id) for image_id in missing], with_payload=["image_id"], with_vectors=True)})
+
+    points, lost = [], []
+    for image_id, artwork in artworks.items():
+        vector = vectors.get(image_id)
+        if vector is None:
+            lost.append(image_id)
+        else:
+            points.append(build_point(artwork, vector))
+    if points:
+        client.upsert(target, points=points)
+    if lost:
+        artwork_collection.update_many({"_id": {"$in": lost}}, {"$set": {"embedding_version": None}})
+
+
+def resync_changes(client, source, target, batch_size=256):
+    redis = redis_conn.redis_client
+    while True:
+        image_ids = [image_id.decode("utf-8") for image_id in redis.spop(REBUILD_CHANGES_KEY, batch_size)]
+        if not image_ids:
+            return
+        resync_points(client, source, target, image_ids)
+
+
+def rebuild_collection(vector_size=None, batch_size=256, copy_vectors=True):
+    """
+    Rebuilds the collection with the current settings and switches COLLECTION_NAME over to it.
+
+    Points are copied into a new collection unless copy_vectors is off (needed when the vector size changes, the
+    artworks then have to be re-embedded). Embedding batches are paused for the whole rebuild and the points other
+    writers touch in the meantime are re-synced from Mongo, before and after the alias switch. A collection that
+    still lives under the plain name (before the first rebuild) has to be dropped before the alias can take its
+    name, writes failing in that moment are repaired by the re-sync after the switch.
+    """
+    client = get_qdrant_instance()
+    old_name = resolve_collection(client)
+    if vector_size is None:
+        if old_name is None:
+            raise ValueError("No collection to rebuild, a vector size is needed")
+        vector_size = client.get_collection(old_name).config.params.vectors.size
+
+    redis = redis_conn.redis_client
+    redis.delete(REBUILD_CHANGES_KEY)
+    # Expires, so a crashed rebuild can't pause embedding forever
+    redis.set(REBUILD_KEY, 1, ex=60 * 60 * 6)
+    copied = 0
+    try:
+        new_name = f"{COLLECTION_NAME}_{int(time.time())}"
+        create_collection(client, new_name, vector_size)
+
+        if old_name is not None and copy_vectors:
+            offset = None
+            while True:
+                points, offset = client.scroll(old_name, limit=batch_size, offset=offset, with_payload=True,
+                                               with_vectors=True)
+                if points:
+                    client.upsert(new_name, points=[PointStruct(id=point.id, vector=point.vector, payload=point.payload)
+                                                    for point in points])
+                    copied += len(points)
+                    print(f"Copied {copied} points into {new_name}")
+                if offset is None:
+                    break
+            resync_changes(client, old_name, new_name, batch_size)
+
+        operations = [CreateAliasOperation(create_alias=CreateAlias(collection_name=new_name, alias_name=COLLECTION_NAME))]
+        if old_name == COLLECTION_NAME:
+            client.delete_collection(old_name)
+        elif old_name is not None:
+            operations.insert(0, DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=COLLECTION_NAME)))
+        client.update_collection_aliases(change_aliases_operations=operations)
+
+        if copy_vectors:
+            time.sleep(REBUILD_SETTLE_SECONDS)
+            source = old_name if old_name not in (None, COLLECTION_NAME) else None
+            resync_changes(client, source, new_name, batch_size)
+    finally:
+        redis.delete(REBUILD_KEY)
+
+    if copy_vectors:
+        # Anything recorded between the last re-sync and the flag going away
+        resync_changes(client, old_name if old_name not in (None, COLLECTION_NAME) else None, new_name, batch_size)
+    if old_name is not None and old_name != COLLECTION_NAME:
+        client.delete_collection(old_name)
+
+    return {"collection": new_name, "copied": copied}
+
+
+def point_id(image_id):
+    hash = hashlib.sha256()
+    hash.update(image_id.encode("utf-8"))
+    return uuid.UUID(hash.hexdigest()[:32]).hex
+
+
+def build_point(artwork, vector):
+    return PointStruct(id=point_id(artwork["_id"]), vector=vector, payload={
+        "image_id": artwork["_id"],
+        "tags": artwork["tags"],
+        "title": artwork.get("title"),
+        "page_no": artwork.get("page_no"),
+        "pixiv_source_id": artwork.get("pixiv_source_id"),
+        "author_name": artwork.get("author_name"),
+    })